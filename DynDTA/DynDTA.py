@@ -14,18 +14,21 @@ __email__ = 'bbarrefo@cse.unl.edu'
 
 import sys
 import datetime
-import math
 import random
 import re
-import base64
-import MySQLdb as msdb
-import MySQLdb.converters
 
-from operator import itemgetter
 from email.mime.text import MIMEText
 from subprocess import call, Popen, PIPE
 
 from DynDTALogger import DynDTALogger
+from DynDTAMITDatabase import DynDTAMITDatabase
+from DynDTAPopularityStore import DynDTAPopularityStore
+from DynDTADeletionIndex import DynDTADeletionIndex
+from DynDTARanking import DynDTARanking
+from DynDTAReplicaIndex import DynDTAReplicaIndex
+from DynDTAReplicaMirror import DynDTAReplicaMirror
+from DynDTASampler import DynDTASampler
+from DynDTASizeCatalog import DynDTASizeCatalog
 from PhEDExAPI import PhEDExAPI
 from PopDBAPI import PopDBAPI
 
@@ -43,20 +46,40 @@ class DynDTA:
     done in a weighted random selection based on the ranking.
 
     Class variables:
-    pop_db_api -- Used to make all popularity db calls
-    phedex_api -- Used to make all phedex calls
+    pop_db_api     -- Used to make all popularity db calls
+    popularity     -- Daily popularity statistics, only new days are downloaded
+    phedex_api     -- Used to make all phedex calls
+    replica_mirror -- Local copy of all AnalysisOps block replicas
+    replica_index  -- AnalysisOps datasets and their replicas of all groups
+    size_catalog   -- Persistent catalog of dataset sizes
+    deletion_index -- Recent deletions at our sites
+    ranking        -- Scores all candidates at once
+    n_candidates   -- Maximum number of candidate datasets
+    seed           -- Seed for the weighted random selection, None for random
     """
-    def __init__(self):
+    def __init__(self, seed=None, formula='popularity'):
         """
         __init__
 
         Set up class constants
+
+        Keyword arguments:
+        seed    -- Seed for the weighted random selection, set for reproducible runs
+        formula -- Name of ranking formula, see DynDTARanking.FORMULAS
         """
         self.logger = DynDTALogger()
         self.pop_db_api = PopDBAPI()
+        self.popularity = DynDTAPopularityStore(self.pop_db_api)
         self.phedex_api = PhEDExAPI()
+        self.replica_mirror = DynDTAReplicaMirror(self.phedex_api)
+        self.replica_index = DynDTAReplicaIndex(replica_mirror=self.replica_mirror)
+        self.size_catalog = DynDTASizeCatalog(self.phedex_api)
+        self.deletion_index = DynDTADeletionIndex(self.phedex_api)
+        self.ranking = DynDTARanking(formula)
         self.time_window = 1
-        self.connectDB()
+        self.n_candidates = 200
+        self.seed = seed
+        self.mit_db = DynDTAMITDatabase()
 
     ############################################################################
     #                                                                          #
@@ -89,58 +112,55 @@ class DynDTA:
                      "T2_TR_METU", "T2_TW_Taiwan", "T2_US_UCSD"]
         exclude = ["T2_IN_TIFR", "T2_CN_Beijing"]
         sites = [site for site in available if site not in exclude]
+        # Sync the AnalysisOps replica mirror and look up replicas of all groups
+        check, n_datasets = self.replica_index.build()
+        if check:
+            return 1
         site_rank, max_budget = self.siteRanking(sites)
         # Restart daily budget in TB
         budget = min(10.0, max_budget)
+        # Download deletions at our sites since last run
+        self.deletion_index.build(sites)
         # Update replicas
         self.updateReplicas()
         # Find candidates. Top 200 accessed sets
         check, candidates = self.candidates()
         if check:
             return 1
+        # Look up sizes of all candidates which are not known or might have changed
+        self.size_catalog.refresh(candidates.keys())
         # Get ranking data. n_access | n_replicas | size_TB
         tstop = datetime.date.today()
         tstart = tstop - datetime.timedelta(days=(2*self.time_window))
-        check, t2_data = self.pop_db_api.getDSStatInTimeWindow(tstart=tstart,
-                                                               tstop=tstop)
+        check, t2_data = self.popularity.statInTimeWindow(tstart, tstop)
         if check:
             return 1
         accesses = {}
         for dataset in t2_data:
             if dataset.get('COLLNAME') in candidates:
                 accesses[dataset.get('COLLNAME')] = dataset.get('NACC')
-        datasets = dict()
-        p_rank = dict()
-        n_access_t = 1
-        n_access_2t = 1
-        n_replicas = 1
-        size_TB = 1
-        for dataset, access in candidates.iteritems():
-            n_access_t = access
-            try:
-                n_access_2t = accesses[dataset]
-            except KeyError:
-                n_access_2t = n_access_t
-            n_replicas = self.nReplicas(dataset)
-            size_TB = self.size(dataset)
-            rank = (math.log10(n_access_t)*max(2*n_access_t
-                    - n_access_2t, 1))/(size_TB*(n_replicas**2))
-            datasets[dataset] = rank
-            p_rank[dataset] = (rank, n_replicas, n_access_t, 2*n_access_t - n_access_2t)
+        # Rank all candidates at once, sets ranked below the threshold are dropped
+        names = candidates.keys()
+        n_access_t = [candidates[dataset] for dataset in names]
+        n_access_2t = [accesses.get(dataset, candidates[dataset]) for dataset in names]
+        n_replicas = [self.nReplicas(dataset) for dataset in names]
+        size_TB = [self.size(dataset) for dataset in names]
+        ranking = self.ranking.rank(names, n_access_t, n_access_2t, n_replicas, size_TB)
+        for dataset, rank in ranking:
+            self.logger.log("Ranking", str(rank) + "\t" + str(dataset))
         # Do weighted random selection
-        sorted_ranking = sorted(datasets.iteritems(), key=itemgetter(1))
-        for rank in sorted_ranking:
-            self.logger.log("Ranking", str(rank[1]) + "\t" + str(rank[0]))
-            if rank[1] < 200:
-                del datasets[rank[0]]
-        sorted_ranking.reverse()
+        datasets = dict(ranking)
         subscriptions = dict()
         for site in sites:
             subscriptions[site] = []
-        while ((budget > 0) and (datasets)):
-            dataset = self.weightedChoice(datasets)
-            # Check if set was already selected
-            del datasets[dataset]
+        rng = random.Random(self.seed)
+        dataset_sampler = DynDTASampler(datasets, rng)
+        site_sampler = DynDTASampler(site_rank, rng)
+        while ((budget > 0) and (dataset_sampler)):
+            # Selected sets are removed from the sampler
+            dataset = dataset_sampler.pop()
+            if dataset is None:
+                break
             size_TB = self.size(dataset)
             if size_TB == 1000:
                 continue
@@ -148,22 +168,22 @@ class DynDTA:
             if self.deleted(dataset, sites):
                 continue
             # Select site
-            # First remove sites which already have dataset
-            available_sites = dict()
+            # Sites which already have dataset can't be selected this time
             site_remove = self.unavailableSites(dataset, site_rank)
-            for k, v in site_rank.iteritems():
-                if k in site_remove:
-                    continue
-                available_sites[k] = v
-            if not available_sites:
+            for site in site_remove:
+                site_sampler.update(site, 0)
+            selected_site = site_sampler.sample()
+            for site in site_remove:
+                site_sampler.update(site, site_rank[site])
+            if selected_site is None:
                 continue
-            selected_site = self.weightedChoice(available_sites)
             if (size_TB > budget):
                 subscriptions[selected_site].append(dataset)
                 break
             subscriptions[selected_site].append(dataset)
             # Update the ranking
             site_rank[selected_site] = site_rank[selected_site] - size_TB
+            site_sampler.update(selected_site, site_rank[selected_site])
             # Keep track of daily budget
             budget -= size_TB
         # Get blocks to subscribe
@@ -192,6 +212,7 @@ class DynDTA:
         #msg['To'] = "bbarrefo@cse.unl.edu"
         p = Popen(["/usr/sbin/sendmail", "-toi"], stdin=PIPE)
         p.communicate(msg.as_string())
+        self.logger.log("Agent", "PhEDEx connections reused: %d new: %d idle: %d" % self.phedex_api.pool.stats())
         self.mit_db.close()
         return 0
 
@@ -203,14 +224,13 @@ class DynDTA:
     def candidates(self):
         tstop = datetime.date.today()
         tstart = tstop - datetime.timedelta(days=self.time_window)
-        check, data = self.pop_db_api.getDSStatInTimeWindow(tstart=tstart,
-                                                            tstop=tstop)
+        check, data = self.popularity.statInTimeWindow(tstart, tstop)
         if check:
             return check, data
         datasets = dict()
         i = 0
         for dataset in data:
-            if i == 200:
+            if i == self.n_candidates:
                 break
             if not (dataset['COLLNAME'].count("/") == 3):
                 continue
@@ -218,14 +238,7 @@ class DynDTA:
                 continue
             elif (dataset['COLLNAME'].find("/AOD") == -1):
                 continue
-            check, response = self.phedex_api.blockReplicas(dataset=dataset['COLLNAME'], group='AnalysisOps')
-            if check:
-                continue
-            data = response.get('phedex')
-            block = data.get('block')
-            try:
-                replicas = block[0].get('replica')
-            except IndexError:
+            if not self.replica_index.contains(dataset['COLLNAME']):
                 continue
             datasets[dataset['COLLNAME']] = dataset['NACC']
             i += 1
@@ -240,21 +253,15 @@ class DynDTA:
         """
         _nReplicas_
 
-        Set up blockreplicas call to PhEDEx API.
+        Number of replicas of dataset of any group according to the replica
+        index.
         """
-        # Don't even bother querying phedex if it is a user dataset
+        # Don't even bother looking it up if it is a user dataset
         if (dataset.find("/USER") != -1):
             return 100
-        check, response = self.phedex_api.blockReplicas(dataset=dataset)
-        if check:
-            return 100
-        data = response.get('phedex')
-        block = data.get('block')
-        try:
-            replicas = block[0].get('replica')
-        except IndexError:
+        n_replicas = self.replica_index.nReplicas(dataset)
+        if not n_replicas:
             return 100
-        n_replicas = len(replicas)
         return n_replicas
 
     ############################################################################
@@ -266,45 +273,16 @@ class DynDTA:
         """
         _datasetSize_
 
-        Get total size of dataset in TB.
+        Get total size of dataset in TB from the size catalog.
         """
-        # Don't even bother querying phedex if it is a user dataset
+        # Don't even bother looking it up if it is a user dataset
         if (dataset.find("/USER") != -1):
             return 1000
-        check, response = self.phedex_api.data(dataset=dataset)
+        check, size = self.size_catalog.size(dataset)
         if check:
             return 1000
-        try:
-            data = response.get('phedex').get('dbs')[0]
-            data = data.get('dataset')[0].get('block')
-        except IndexError:
-            return 1000
-        size = float(0)
-        for block in data:
-            size += block.get('bytes')
-        size = size / 10**12
         return size
 
-    ############################################################################
-    #                                                                          #
-    #                      W E I G H T E D   C H O I C E                       #
-    #                                                                          #
-    ############################################################################
-    def weightedChoice(self, choices):
-        """
-        _weightedChoice_
-
-        Return a weighted randomly selected object.
-        Expects a dictionary.
-        """
-        total = sum(w for c, w in choices.iteritems())
-        r = random.uniform(0, total)
-        upto = 0
-        for c, w in choices.iteritems():
-            if upto + w > r:
-                return c
-            upto += w
-
     ############################################################################
     #                                                                          #
     #                            R E P L I C A S                              #
@@ -315,22 +293,12 @@ class DynDTA:
         """
         _replicas_
 
-        Return the sites at which dataset have replicas.
+        Check if dataset have a replica at node.
         """
-        # Don't even bother querying phedex if it is a user dataset
+        # Don't even bother looking it up if it is a user dataset
         if (dataset.find("/USER") != -1):
             return True
-        check, response = self.phedex_api.blockReplicas(dataset=dataset,
-                                                        node=node)
-        if check:
-            return True
-        data = response.get('phedex')
-        block = data.get('block')
-        try:
-            block[0].get('replica')
-        except IndexError:
-            return False
-        return True
+        return self.replica_index.hasReplica(dataset, node)
 
     ############################################################################
     #                                                                          #
@@ -375,19 +343,9 @@ class DynDTA:
         """
         _deleted_
 
-        Check if dataset was deleted from any of the sites by AnalysisOps in the
-        last 2 weeks.
+        Check if dataset was deleted from any of the sites in the last 30 days.
         """
-        for site in sites:
-            check, response = self.phedex_api.deletions(node=site, dataset=dataset,
-                                                        request_since='last_30days')
-            if check:
-                return False
-            try:
-                response.get('phedex').get('dataset')[0]
-            except IndexError:
-                return False
-        return True
+        return self.deletion_index.deleted(dataset, sites)
 
     ############################################################################
     #                                                                          #
@@ -401,34 +359,19 @@ class DynDTA:
         Rank the sites based on available storage
         """
         # Get quotas
-        cur = self.mit_db.cursor();
+        quotas = self.mit_db.quotas(sites, "AnalysisOps")
         site_rank = dict()
         max_budget = 0
+        used = self.replica_mirror.usedSpace("AnalysisOps")
         for site in sites:
-            check, response = self.phedex_api.blockReplicas(node=site,
-                                                            group="AnalysisOps")
-            if check:
-                site_rank[site] = 0
-            blocks = response.get('phedex').get('block')
-            used_space = float(0)
-            for block in blocks:
-                replica = block.get('replica')
-                if replica[0].get('subscribed') == 'y':
-                    bytes = block.get('bytes')
-                else:
-                    bytes = replica[0].get('bytes')
-                used_space += bytes
-            used_space = used_space / 10**12
-            cur.execute("SELECT SizeTb FROM Quotas WHERE SiteName=%s and GroupName=%s", (site, "AnalysisOps"))
-            site_quota = cur.fetchone()
-            if not site_quota:
+            used_space = used.get(site, 0)
+            if site not in quotas:
                 continue
-            site_quota = int(site_quota[0])
+            site_quota = int(quotas[site])
             rank = (0.95*site_quota) - used_space
             if (rank >= 30):
                 site_rank[site] = rank
                 max_budget += rank
-        cur.close()
         return site_rank, max_budget
 
     ############################################################################
@@ -440,22 +383,13 @@ class DynDTA:
         """
         _unavailableSites_
 
-        Find all of our sites which already has the dataset
+        Find all of our sites which already has the dataset, whatever group
+        owns the replica
         """
         unavailable_sites = dict()
         for site, rank in site_rank.iteritems():
-            check, response = self.phedex_api.blockReplicas(dataset=dataset,
-                                                            node=site)
-            if check:
+            if self.replica_index.hasReplica(dataset, site):
                 unavailable_sites[site] = rank
-                continue
-            data = response.get('phedex')
-            block = data.get('block')
-            try:
-                block[0].get('replica')
-            except IndexError:
-                continue
-            unavailable_sites[site] = rank
         return unavailable_sites
 
     ############################################################################
@@ -468,57 +402,46 @@ class DynDTA:
         addReplica
 
         Add new replicas entry in the db
-        """
-        # Get all datasets from phedex
-        check, response = self.phedex_api.blockReplicas(group="AnalysisOps", show_dataset="y")
-        data = response.get('phedex').get('dataset')
-        datasets = []
-        for d in data:
-            datasets.append(d.get('name'))
-        cur = self.mit_db.cursor();
-        for dataset in datasets:
-            n_replicas = self.nReplicas(dataset)
-            cur.execute("SELECT DatasetId FROM Datasets WHERE Dataset=%s", (dataset,))
-            dataset_id = cur.fetchone()
-            if not dataset_id:
-                cur.execute("INSERT INTO Datasets (Dataset) VALUES (%s)", (dataset))
-                cur.execute("SELECT DatasetId FROM Datasets WHERE Dataset=%s", (dataset,))
-                dataset_id = cur.fetchone()
-            dataset_id = int(dataset_id[0])
-            cur.execute("SELECT Replicas FROM Replicas WHERE DatasetId=%s", (dataset_id,))
-            replicas = cur.fetchone()
-            if (not replicas):
-                cur.execute("INSERT INTO Replicas (DatasetId, Replicas) VALUES (%s, %s)", (dataset_id, n_replicas))
-            else:
-                replicas = int(replicas[0])
-                if not (replicas == n_replicas):
-                    cur.execute("INSERT INTO Replicas (DatasetId, Replicas) VALUES (%s, %s)", (dataset_id, n_replicas))
-        cur.close()
-
-    ############################################################################
-    #                                                                          #
-    #                           C O N N E C T   D B                            #
-    #                                                                          #
-    ############################################################################
-    def connectDB(self):
-        """
-        _connectDB_
 
-        Connect to the MySQL DB at MIT
+        Replica counts come from the replica index, datasets are loaded with one
+        query and all new rows are inserted in bulk in one transaction. A row is
+        added for datasets whose count differs from the one stored.
         """
-        # Get server, username, and password from file
-        db_file = open('/home/bockelman/barrefors/db/login')
-        host = db_file.readline().strip()
-        db = db_file.readline().strip()
-        user = db_file.readline().strip()
-        passwd = db_file.readline().strip()
-        # Decode the address, username, and password
-        host = base64.b64decode(host)
-        db = base64.b64decode(db)
-        user = base64.b64decode(user)
-        passwd = base64.b64decode(passwd)
-        # Connect to DB
-        self.mit_db = msdb.connect(host=host, user=user, passwd=passwd, db=db)
+        # All AnalysisOps datasets are already in the replica index
+        n_replicas = dict((dataset, self.nReplicas(dataset)) for dataset in self.replica_index.datasets())
+        try:
+            cur = self.mit_db.cursor()
+        except (self.mit_db.Error, IOError), e:
+            self.logger.error("updateReplicas", "Couldn't connect to MIT database. Reason: %s" % (str(e),))
+            return 1
+        try:
+            cur.execute("SELECT Dataset, DatasetId FROM Datasets")
+            dataset_ids = dict(cur.fetchall())
+            new_datasets = [(dataset,) for dataset in n_replicas if dataset not in dataset_ids]
+            if new_datasets:
+                cur.executemany("INSERT INTO Datasets (Dataset) VALUES (%s)", new_datasets)
+                cur.execute("SELECT Dataset, DatasetId FROM Datasets")
+                dataset_ids = dict(cur.fetchall())
+            rows = []
+            for dataset, count in n_replicas.iteritems():
+                dataset_id = int(dataset_ids[dataset])
+                cur.execute("SELECT Replicas FROM Replicas WHERE DatasetId=%s", (dataset_id,))
+                replicas = cur.fetchone()
+                if (not replicas) or (int(replicas[0]) != count):
+                    rows.append((dataset_id, count))
+            cur.executemany("INSERT INTO Replicas (DatasetId, Replicas) VALUES (%s, %s)", rows)
+            self.mit_db.commit()
+        except (self.mit_db.Error, IOError), e:
+            self.mit_db.rollback()
+            self.logger.error("updateReplicas", "Couldn't update replicas. Reason: %s" % (str(e),))
+            return 1
+        except KeyError:
+            # Dataset missing from Datasets after insert, not safe to go on
+            self.mit_db.rollback()
+            raise
+        finally:
+            cur.close()
+        self.logger.log("updateReplicas", "%d new datasets, %d changed replica counts" % (len(new_datasets), len(rows)))
         return 0
 
 ################################################################################
@@ -534,8 +457,10 @@ if __name__ == '__main__':
     This is where it all starts
     """
     test = 0
-    if len(sys.argv) == 2:
+    seed = None
+    if len(sys.argv) >= 2:
         test = int(sys.argv[1])
-    agent = DynDTA()
+    if len(sys.argv) >= 3:
+        seed = int(sys.argv[2])
+    agent = DynDTA(seed=seed)
     sys.exit(agent.agent(test=test))
-    #sys.exit(agent.connectDB())
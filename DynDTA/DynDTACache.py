@@ -0,0 +1,265 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTACache_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import time
+import zlib
+import urllib
+import threading
+import sqlite3 as lite
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from DynDTALogger import DynDTALogger
+
+
+################################################################################
+#                                                                              #
+#                            D Y N D T A   C A C H E                           #
+#                                                                              #
+################################################################################
+
+class DynDTACache:
+    """
+    _DynDTACache_
+
+    On disk cache of decoded responses from read only API calls.
+
+    Entries are keyed on the endpoint and the non empty call arguments in
+    sorted order, stored zlib compressed and expire after the TTL of their
+    endpoint. When the cache grows past max_bytes the least recently used
+    entries are evicted. The cache is a SQLite file in WAL mode so all
+    processes on the same host can share it.
+
+    To keep writers from contending for the lock the access time of an entry
+    is only updated once it is touch seconds old, and eviction runs at most
+    every evict_interval seconds per process or once the process has written
+    a hundredth of max_bytes. The cache can go over max_bytes by that much.
+
+    Class variables:
+    name           -- ID used when logging
+    logger         -- Used to print log and error messages to log file
+    db             -- Path to database file
+    max_bytes      -- Maximum total size of compressed entries
+    touch          -- Seconds before the access time of an entry is updated
+    evict_interval -- Seconds between evictions
+    evicted        -- Time of last eviction
+    written        -- Bytes written since last eviction
+    TTL            -- Endpoint -> time to live in seconds, 0 means don't cache
+    """
+    TTL = { 'data'             : 6*3600,
+            'blockreplicas'    : 3600,
+            'deletions'        : 3600,
+            'requestList'      : 600,
+            'transferRequests' : 600 }
+
+    def __init__(self, db_path='/home/bockelman/barrefors/db/', db_file='phedex_cache.db',
+                 max_bytes=1024**3, touch=300, evict_interval=60):
+        """
+        __init__
+
+        Create logger object and set up database
+
+        Keyword arguments:
+        db_path        -- Path to database file
+        db_file        -- File name of database
+        max_bytes      -- Maximum total size of compressed entries
+        touch          -- Seconds before the access time of an entry is updated
+        evict_interval -- Seconds between evictions
+        """
+        self.name           = "DynDTACache"
+        self.logger         = DynDTALogger()
+        self.db             = db_path + db_file
+        self.max_bytes      = max_bytes
+        self.touch          = touch
+        self.evict_interval = evict_interval
+        self.evicted        = 0
+        self.written        = 0
+        self.TTL            = dict(DynDTACache.TTL)
+        self.local          = threading.local()
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+            # Readers don't block the writer, stays set in the file
+            self.connect().execute('PRAGMA journal_mode=WAL')
+            with self.connect() as connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS ResponseCache (Key TEXT PRIMARY KEY, Expiration REAL, Accessed REAL, Size INTEGER, Data BLOB)')
+                connection.execute('CREATE INDEX IF NOT EXISTS ResponseCacheAccessed ON ResponseCache (Accessed)')
+        except (OSError, lite.Error), e:
+            # Run without a cache rather than not at all
+            self.logger.error(self.name, "Couldn't initialize cache. Reason: %s" % (e,))
+            self.max_bytes = 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                              C O N N E C T                               #
+    #                                                                          #
+    ############################################################################
+
+    def connect(self):
+        """
+        _connect_
+
+        Get the database connection of the current thread and process
+
+        SQLite connections can't be shared between threads or forked processes
+        so each one opens its own.
+        """
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = lite.connect(self.db, timeout=30)
+            self.local.connection.text_factory = str
+            self.local.connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  K E Y                                   #
+    #                                                                          #
+    ############################################################################
+
+    def key(self, endpoint, values):
+        """
+        _key_
+
+        Normalize endpoint and arguments to a cache key
+
+        Arguments with empty values are the same as not passing them.
+        """
+        args = sorted((k, v) for k, v in values.iteritems() if v not in ('', None))
+        return "%s?%s" % (endpoint, urllib.urlencode(args, True))
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  G E T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def get(self, endpoint, values, instance='prod'):
+        """
+        _get_
+
+        Look up a cached response
+
+        Keyword arguments:
+        endpoint -- Name of API call, ex 'data'
+        values   -- Arguments of the call
+        instance -- Which instance of PhEDEx was queried
+
+        Return values:
+        check -- 0 if found, 1 if not in cache or expired
+        data  -- The decoded response
+        """
+        if not (self.max_bytes and self.TTL.get(endpoint)):
+            return 1, "Not cached"
+        key = self.key("%s/%s" % (instance, endpoint), values)
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                row = connection.execute('SELECT Data, Accessed FROM ResponseCache WHERE Key=? AND Expiration>?', (key, now)).fetchone()
+                if not row:
+                    return 1, "Not in cache"
+                if now - row[1] > self.touch:
+                    connection.execute('UPDATE ResponseCache SET Accessed=? WHERE Key=?', (now, key))
+        except lite.Error, e:
+            self.logger.error(self.name, "Couldn't read cache. Reason: %s" % (e,))
+            return 1, "Error"
+        return 0, json.loads(zlib.decompress(row[0]))
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  P U T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def put(self, endpoint, values, data, instance='prod'):
+        """
+        _put_
+
+        Store a decoded response and evict old entries if cache is full
+
+        Keyword arguments:
+        endpoint -- Name of API call, ex 'data'
+        values   -- Arguments of the call
+        data     -- The decoded response
+        instance -- Which instance of PhEDEx was queried
+        """
+        ttl = self.TTL.get(endpoint)
+        if not (self.max_bytes and ttl):
+            return 1
+        key = self.key("%s/%s" % (instance, endpoint), values)
+        blob = zlib.compress(json.dumps(data))
+        if len(blob) > self.max_bytes:
+            return 1
+        now = time.time()
+        try:
+            with self.connect() as connection:
+                connection.execute('INSERT OR REPLACE INTO ResponseCache VALUES(?,?,?,?,?)', (key, now + ttl, now, len(blob), lite.Binary(blob)))
+                self.written += len(blob)
+                if (now - self.evicted > self.evict_interval) or (self.written*100 > self.max_bytes):
+                    self.evict(connection, now)
+        except lite.Error, e:
+            self.logger.error(self.name, "Couldn't write cache. Reason: %s" % (e,))
+            return 1
+        return 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                                E V I C T                                 #
+    #                                                                          #
+    ############################################################################
+
+    def evict(self, connection, now):
+        """
+        _evict_
+
+        Delete expired entries, then least recently used entries until the
+        cache is back under max_bytes
+        """
+        self.evicted = now
+        self.written = 0
+        connection.execute('DELETE FROM ResponseCache WHERE Expiration<=?', (now,))
+        total = connection.execute('SELECT SUM(Size) FROM ResponseCache').fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+        keys = []
+        for key, size in connection.execute('SELECT Key, Size FROM ResponseCache ORDER BY Accessed'):
+            if total <= self.max_bytes:
+                break
+            keys.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM ResponseCache WHERE Key=?', keys)
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    cache = DynDTACache()
+    cache.put('data', {'dataset' : '/A/B/C', 'block' : ''}, {'phedex' : {}})
+    print cache.get('data', {'dataset' : '/A/B/C'})
+    sys.exit(0)
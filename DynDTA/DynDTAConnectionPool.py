@@ -0,0 +1,406 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAConnectionPool_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import ssl
+import errno
+import socket
+import httplib
+import urlparse
+import threading
+
+
+################################################################################
+#                                                                              #
+#                 D Y N D T A   C O N N E C T I O N   P O O L                  #
+#                                                                              #
+################################################################################
+
+class DynDTAConnectionPool:
+    """
+    _DynDTAConnectionPool_
+
+    Keep-alive HTTPS connections shared between calls and threads.
+
+    Connections are kept per host and handed out to one caller at a time, a
+    connection is only put back once its response has been read completely.
+    When proxy is set the grid proxy is used as both key and certificate and
+    all idle connections are dropped as soon as the proxy file changes.
+
+    Class variables:
+    key_file   -- Private key used for client authentication
+    cert_file  -- Certificate used for client authentication
+    proxy      -- Use the grid proxy as key and certificate
+    verify     -- Verify the server certificate
+    max_idle   -- Maximum number of idle connections kept per host
+    timeout    -- Socket timeout in seconds
+    hits       -- Number of requests served on a reused connection
+    misses     -- Number of requests which had to open a new connection
+    """
+    def __init__(self, key_file=None, cert_file=None, proxy=False, verify=True,
+                 max_idle=8, timeout=300):
+        """
+        __init__
+
+        Set up class constants
+
+        Keyword arguments:
+        key_file  -- Private key used for client authentication
+        cert_file -- Certificate used for client authentication
+        proxy     -- Use the grid proxy as key and certificate
+        verify    -- Verify the server certificate
+        max_idle  -- Maximum number of idle connections kept per host
+        timeout   -- Socket timeout in seconds
+        """
+        self.key_file     = key_file
+        self.cert_file    = cert_file
+        self.proxy        = proxy
+        self.context      = None
+        if not verify:
+            self.context  = ssl._create_unverified_context()
+        self.max_idle     = max_idle
+        self.timeout      = timeout
+        self.lock         = threading.Lock()
+        self.idle         = dict()
+        self.generation   = 0
+        self.proxy_mtime  = None
+        self.pid          = os.getpid()
+        self.hits         = 0
+        self.misses       = 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                             G E T   P R O X Y                            #
+    #                                                                          #
+    ############################################################################
+
+    def getProxy(self):
+        """
+        _getProxy_
+
+        Path to the grid proxy of the current user
+        """
+        proxy = os.environ.get("X509_USER_PROXY")
+        if not proxy:
+            proxy = "/tmp/x509up_u%d" % (os.geteuid(),)
+        return proxy
+
+
+    ############################################################################
+    #                                                                          #
+    #                           C H E C K   P O O L                            #
+    #                                                                          #
+    ############################################################################
+
+    def checkPool(self):
+        """
+        _checkPool_
+
+        Drop idle connections which can't be used anymore, either because the
+        proxy was renewed or because we are in a forked child process.
+
+        Must be called with lock held.
+        """
+        if os.getpid() != self.pid:
+            # Sockets belong to the parent, forget them without closing
+            self.pid = os.getpid()
+            self.idle = dict()
+            self.generation += 1
+        if not self.proxy:
+            return
+        proxy = self.getProxy()
+        try:
+            mtime = os.path.getmtime(proxy)
+        except OSError:
+            mtime = None
+        if (proxy != self.key_file) or (mtime != self.proxy_mtime):
+            self.key_file = proxy
+            self.cert_file = proxy
+            self.proxy_mtime = mtime
+            self.closeIdle()
+            self.generation += 1
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  G E T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def get(self, host):
+        """
+        _get_
+
+        Get an idle connection to host or open a new one
+
+        Return values:
+        connection -- HTTPS connection to host
+        reused     -- True if the connection was used before
+        """
+        self.lock.acquire()
+        try:
+            self.checkPool()
+            connections = self.idle.get(host)
+            if connections:
+                self.hits += 1
+                return connections.pop(), True
+            self.misses += 1
+            key_file, cert_file, generation = self.key_file, self.cert_file, self.generation
+        finally:
+            self.lock.release()
+        connection = httplib.HTTPSConnection(host, key_file=key_file,
+                                             cert_file=cert_file,
+                                             timeout=self.timeout,
+                                             context=self.context)
+        connection.generation = generation
+        return connection, False
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  P U T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def put(self, host, connection):
+        """
+        _put_
+
+        Give a connection back to the pool once its response have been read
+        """
+        self.lock.acquire()
+        try:
+            self.checkPool()
+            connections = self.idle.setdefault(host, [])
+            if (connection.generation == self.generation) and (len(connections) < self.max_idle):
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+
+    ############################################################################
+    #                                                                          #
+    #                              R E Q U E S T                               #
+    #                                                                          #
+    ############################################################################
+
+    def request(self, method, url, body=None, headers={}, stream=False):
+        """
+        _request_
+
+        Make a HTTPS request on a pooled connection
+
+        A request on a reused connection is retried once on a new connection
+        if the server had closed the idle connection before the request
+        reached it, see closedIdle. Any other error, including timeouts, is
+        never retried as the server might already have acted on the request.
+
+        Exceptions from httplib and socket are left for the caller to handle.
+
+        Keyword arguments:
+        method  -- HTTP method, GET or POST
+        url     -- Full URL to request
+        body    -- Request body
+        headers -- Additional HTTP headers
+        stream  -- Don't read the body, return a file like response instead
+
+        Return values:
+        response -- httplib response, already read unless stream is set
+        data     -- Body of the response or a DynDTAPooledResponse if stream
+        """
+        url = urlparse.urlsplit(url)
+        host = url.netloc
+        path = urlparse.urlunsplit(('', '', url.path or '/', url.query, ''))
+        retried = False
+        while True:
+            connection, reused = self.get(host)
+            sent = False
+            try:
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+                if stream:
+                    return response, DynDTAPooledResponse(self, host, connection, response)
+                data = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused and not retried and self.closedIdle(e, sent):
+                    retried = True
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.put(host, connection)
+            return response, data
+
+
+    ############################################################################
+    #                                                                          #
+    #                          C L O S E D   I D L E                           #
+    #                                                                          #
+    ############################################################################
+
+    def closedIdle(self, error, sent):
+        """
+        _closedIdle_
+
+        Check if a request failed because the server closed the connection
+        while it was idle, either the request couldn't be sent or the server
+        closed the connection without sending any response
+
+        Keyword arguments:
+        error -- Exception raised by the request
+        sent  -- True if the request was sent
+
+        Return values:
+        closed -- True if it is safe to retry the request
+        """
+        if sent:
+            return isinstance(error, httplib.BadStatusLine)
+        if isinstance(error, socket.timeout):
+            return False
+        return isinstance(error, socket.error) and (error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+    ############################################################################
+    #                                                                          #
+    #                           C L O S E   I D L E                            #
+    #                                                                          #
+    ############################################################################
+
+    def closeIdle(self):
+        """
+        _closeIdle_
+
+        Close all idle connections
+
+        Must be called with lock held.
+        """
+        for connections in self.idle.itervalues():
+            for connection in connections:
+                connection.close()
+        self.idle = dict()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                S T A T S                                 #
+    #                                                                          #
+    ############################################################################
+
+    def stats(self):
+        """
+        _stats_
+
+        Get pool counters
+
+        Return values:
+        hits   -- Requests served on a reused connection
+        misses -- Requests which opened a new connection
+        idle   -- Number of idle connections currently in pool
+        """
+        self.lock.acquire()
+        try:
+            idle = sum(len(connections) for connections in self.idle.itervalues())
+            return self.hits, self.misses, idle
+        finally:
+            self.lock.release()
+
+
+################################################################################
+#                                                                              #
+#                D Y N D T A   P O O L E D   R E S P O N S E                   #
+#                                                                              #
+################################################################################
+
+class DynDTAPooledResponse:
+    """
+    _DynDTAPooledResponse_
+
+    File like body of a streamed response.
+
+    The connection goes back to the pool as soon as the body have been read to
+    the end. Closing a response before that closes the connection.
+
+    Class variables:
+    pool       -- Pool the connection belongs to
+    host       -- Host the connection is open to
+    connection -- Connection the response is read from, None once released
+    response   -- httplib response
+    """
+    def __init__(self, pool, host, connection, response):
+        """
+        __init__
+
+        Set up class constants
+        """
+        self.pool       = pool
+        self.host       = host
+        self.connection = connection
+        self.response   = response
+
+    def read(self, amt=None):
+        """
+        _read_
+
+        Read up to amt bytes of the body, everything if amt is None
+        """
+        data = self.response.read(amt)
+        if self.response.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        """
+        _release_
+
+        Give the connection back to the pool once the body is fully read
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.put(self.host, connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """
+        _close_
+
+        Stop reading, the connection is closed if the body wasn't fully read
+        """
+        self.release()
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    pool = DynDTAConnectionPool(proxy=True)
+    for i in range(3):
+        response, data = pool.request('GET', "https://cmsweb.cern.ch/phedex/datasvc/json/prod/bounce")
+        print response.status
+    print "Hits: %d Misses: %d Idle: %d" % pool.stats()
+    sys.exit(0)
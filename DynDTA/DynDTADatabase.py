@@ -15,6 +15,7 @@ __email__        = 'bbarrefo@cse.unl.edu'
 
 import sys
 import os.path
+import time
 import datetime
 import urllib
 import sqlite3 as lite
@@ -34,11 +35,25 @@ class DynDTADatabase():
 
     Manage the database keeping track of which datasets have been accessed and when.
 
+    Accesses are aggregated in one counter per dataset and hour so the database
+    grows with the number of datasets and hours, not with accesses.
+
+    Inserts are buffered in memory and written in one transaction once
+    batch_size rows are buffered or flush_ms milliseconds have passed since the
+    last write. The database is in WAL mode so readers don't block writers.
+
     Class variables:
-    connection -- Established connection to the database
-    logger     -- Used to print log and error messages to log file
+    connection  -- Established connection to the database
+    logger      -- Used to print log and error messages to log file
+    dataset_ids -- Dataset name -> id in the Dataset table
+    batch_size  -- Flush when this many rows are buffered
+    flush_ms    -- Flush when this many milliseconds passed since last flush
+    accesses    -- Buffered accesses, (dataset, hour) -> count
+    dir_rows    -- Buffered (directory, dataset, expiration) rows
+    flushed     -- Time of last flush
     """
-    def __init__(self, db_path='/home/bockelman/barrefors/db/', db_file='cmsdata.db'):
+    def __init__(self, db_path='/home/bockelman/barrefors/db/', db_file='cmsdata.db',
+                 batch_size=1000, flush_ms=1000):
         """
         __init__
 
@@ -46,8 +61,10 @@ class DynDTADatabase():
         Establish database connection and set up database
 
         Keyword arguments:
-        db_path -- Path to database file
-        db_file -- File name of database
+        db_path    -- Path to database file
+        db_file    -- File name of database
+        batch_size -- Flush when this many rows are buffered
+        flush_ms   -- Flush when this many milliseconds passed since last flush
         """
         # Alternative db paths:
         # /home/barrefors/cmsdata/db/
@@ -55,20 +72,42 @@ class DynDTADatabase():
 
         self.name = "DynDTADatabase"
         self.logger = DynDTALogger()
+        self.dataset_ids = dict()
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.accesses = dict()
+        self.dir_rows = []
+        self.flushed = time.time()
         try:
             if not os.path.isdir(db_path):
                 os.makedirs(db_path)
         except OSError, e:
             # Couldn't create path to db file
-            self.logger.error(name, "Couldn\'t access db file. Reason: %s" % (e,))
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
             sys.exit(1)
 
-        self.connection = lite.connect(db_path + db_file)
+        # Several worker processes share the database, wait for locks
+        self.connection = lite.connect(db_path + db_file, timeout=30)
         try:
+            # Fsync on checkpoints only, a crash can lose the last transactions
+            # but not corrupt the database
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
             with self.connection:
                 cur = self.connection.cursor()
-                cur.execute('CREATE TABLE IF NOT EXISTS DatasetRanking (Dataset TEXT, Ranking REAL, n_Replicas INTEGER, size REAL, n_tUsers INTEGER, n_tAccesses INTEGER, n_2tUsers INTEGER, n_2tAccesses INTEGER)')EXT
-                cur.execute('CREATE TABLE IF NOT EXISTS DatasetAvailability (Dataset TEXT, Site T)')
+                cur.execute('CREATE TABLE IF NOT EXISTS DirectoryDataset (Directory TEXT, Dataset TEXT, Expiration TIMESTAMP)')
+                cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='DirectoryDatasetDirectory'")
+                if not cur.fetchone():
+                    # Older databases can have several rows per directory, keep the one expiring last
+                    cur.execute('DELETE FROM DirectoryDataset WHERE rowid NOT IN (SELECT rowid FROM (SELECT rowid, MAX(Expiration) FROM DirectoryDataset GROUP BY Directory))')
+                    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS DirectoryDatasetDirectory ON DirectoryDataset (Directory)')
+                cur.execute('CREATE TABLE IF NOT EXISTS Dataset (DatasetId INTEGER PRIMARY KEY, Name TEXT UNIQUE)')
+                cur.execute('CREATE TABLE IF NOT EXISTS DatasetAccessCount (DatasetId INTEGER, Hour INTEGER, Count INTEGER, PRIMARY KEY (DatasetId, Hour))')
+                cur.execute('CREATE INDEX IF NOT EXISTS DatasetAccessCountHour ON DatasetAccessCount (Hour)')
+                cur.execute('CREATE TABLE IF NOT EXISTS DatasetRanking (Dataset TEXT, Ranking REAL, n_Replicas INTEGER, size REAL, n_tUsers INTEGER, n_tAccesses INTEGER, n_2tUsers INTEGER, n_2tAccesses INTEGER)')
+                cur.execute('CREATE TABLE IF NOT EXISTS DatasetAvailability (Dataset TEXT, Site TEXT)')
+                cur.execute('SELECT Name, DatasetId FROM Dataset')
+                self.dataset_ids = dict(cur.fetchall())
         except lite.IntegrityError:
             self.logger.error(self.name, "Couldn't initialize database")
             sys.exit(1)
@@ -86,22 +125,55 @@ class DynDTADatabase():
 
         Find which dataset files in a directory belongs to in cache if available
 
-        If not return 1
+        If not return 1. Directories which couldn't be resolved are cached with
+        an empty dataset name, see insertDirectory.
 
         Arguments:
         dir_name -- Base directory of file
+
+        Return values:
+        check   -- 0 if found, 1 if not in db or expired
+        dataset -- Name of dataset, '' if the directory couldn't be resolved
+        ttl     -- Seconds until the entry expires
         """
         try:
             with self.connection:
                 cur = self.connection.cursor()
-                cur.execute("SELECT Dataset FROM DirectoryDataset WHERE Directory=?", (dir_name,))
+                now = datetime.datetime.now()
+                cur.execute("SELECT Dataset, (julianday(Expiration) - julianday(?))*86400 FROM DirectoryDataset WHERE Directory=? AND Expiration>?", (now, dir_name, now))
                 dataset = cur.fetchone()
                 if not dataset:
-                    return 1, "Not in db"
+                    return 1, "Not in db", 0
+        except lite.IntegrityError:
+            self.logger.error(self.name, "Exception while querying database")
+            return 1, "Error", 0
+        return 0, dataset[0], dataset[1]
+
+
+    ############################################################################
+    #                                                                          #
+    #                            D I R E C T O R I E S                         #
+    #                                                                          #
+    ############################################################################
+
+    def directories(self):
+        """
+        _directories_
+
+        Get all resolved directories in the cache which have not expired
+
+        Return values:
+        directories -- List of (directory, dataset)
+        """
+        directories = []
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute("SELECT Directory, Dataset FROM DirectoryDataset WHERE Expiration>? AND Dataset!=''", (datetime.datetime.now(),))
+                directories = cur.fetchall()
         except lite.IntegrityError:
             self.logger.error(self.name, "Exception while querying database")
-            return 1, "Error"
-        return 0, dataset[0]
+        return directories
 
 
     ############################################################################
@@ -110,27 +182,30 @@ class DynDTADatabase():
     #                                                                          #
     ############################################################################
 
-    def insertDirectory(self, dir_name, dataset):
+    def insertDirectory(self, dir_name, dataset, hours=24):
         """
         _insertDirectory_
 
-        Insert dir_name and dataset to FileSet table
+        Insert dir_name and dataset to FileSet table, replacing any earlier
+        row of dir_name
         Set an expiration time for the cache to avoid too much data in database
 
+        A directory which couldn't be resolved is inserted with an empty dataset
+        name and a shorter expiration so it isn't looked up for every access.
+
+        The row is buffered, see flush.
+
         Arguments:
         dir_name -- Base director of file accessed
-        dataset  -- Name of datatset file belongs to
+        dataset  -- Name of datatset file belongs to, '' if not resolved
+        hours    -- Hours until the entry expires
         """
-        try:
-            with self.connection:
-                cur = self.connection.cursor()
-                # Set cache expiration to 24h for now
-                expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
-                cur.execute('INSERT INTO DirectoryDataset VALUES(?,?,?)', (dir_name, dataset, expiration))
-        except lite.IntegrityError:
-            self.logger.error(self.name, "Exception while inserting data")
+        expiration = datetime.datetime.now() + datetime.timedelta(hours=hours)
+        self.dir_rows.append((dir_name, dataset, expiration))
+        self.flushDue()
         return 0
 
+
     ############################################################################
     #                                                                          #
     #                            C L E A N   C A C H E                         #
@@ -159,49 +234,173 @@ class DynDTADatabase():
     #                                                                          #
     ############################################################################
 
-    def insertDataset(self, dataset):
+    def insertDataset(self, dataset, count=1):
         """
         _insertDataset_
 
-        Insert dataset with expiration time to the dataset
-        Expiration time is based on how long we want to keep track of # accesses
+        Count accesses of dataset in the bucket of the current hour
 
-        For now the expiration is set to 3 days
+        Accesses are not stored one by one, each dataset have one counter per
+        hour. See cleanAccess for how long counters are kept. The access is
+        buffered, see flush.
 
         Arguments:
         dataset -- Name of datatset that was accessed
+        count   -- Number of accesses
+        """
+        key = (dataset, self.hour())
+        self.accesses[key] = self.accesses.get(key, 0) + count
+        self.flushDue()
+        return 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                             F L U S H   D U E                            #
+    #                                                                          #
+    ############################################################################
+
+    def flushDue(self):
+        """
+        _flushDue_
+
+        Flush buffered rows if enough rows are buffered or they are old enough
         """
+        if ((len(self.accesses) + len(self.dir_rows)) >= self.batch_size) or ((time.time() - self.flushed)*1000 >= self.flush_ms):
+            self.flush()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                 F L U S H                                #
+    #                                                                          #
+    ############################################################################
+
+    def flush(self):
+        """
+        _flush_
+
+        Write all buffered rows in one transaction
+
+        Rows are dropped if the transaction fails so the buffers can't grow
+        without bound while the database is unavailable.
+        """
+        self.flushed = time.time()
+        if not (self.accesses or self.dir_rows):
+            return 0
+        accesses, self.accesses = self.accesses, dict()
+        dir_rows, self.dir_rows = self.dir_rows, []
         try:
             with self.connection:
                 cur = self.connection.cursor()
-                # Set time window to 24h for now
-                expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
-                cur.execute('INSERT INTO DatasetAccess VALUES(?,?)', (dataset, expiration))
-        except lite.IntegrityError:
-            self.logger.error(self.name, "Exception while inserting data")
+                cur.executemany('INSERT OR REPLACE INTO DirectoryDataset VALUES(?,?,?)', dir_rows)
+                counts = [(count, self.datasetId(cur, dataset), hour) for (dataset, hour), count in accesses.iteritems()]
+                cur.executemany('INSERT OR IGNORE INTO DatasetAccessCount VALUES(?,?,0)', [(dataset_id, hour) for count, dataset_id, hour in counts])
+                cur.executemany('UPDATE DatasetAccessCount SET Count=Count+? WHERE DatasetId=? AND Hour=?', counts)
+        except lite.Error:
+            # New datasets might have been rolled back
+            self.dataset_ids = dict()
+            self.logger.error(self.name, "Exception while inserting data, dropped %d rows" % (len(accesses) + len(dir_rows),))
+            return 1
         return 0
 
 
+    ############################################################################
+    #                                                                          #
+    #                            D A T A S E T   I D                           #
+    #                                                                          #
+    ############################################################################
+
+    def datasetId(self, cur, dataset):
+        """
+        _datasetId_
+
+        Get id of dataset, the dataset is added if not known
+
+        Arguments:
+        cur     -- Cursor of open transaction
+        dataset -- Name of dataset
+        """
+        try:
+            return self.dataset_ids[dataset]
+        except KeyError:
+            pass
+        cur.execute('INSERT OR IGNORE INTO Dataset (Name) VALUES(?)', (dataset,))
+        cur.execute('SELECT DatasetId FROM Dataset WHERE Name=?', (dataset,))
+        dataset_id = cur.fetchone()[0]
+        self.dataset_ids[dataset] = dataset_id
+        return dataset_id
+
+
+    ############################################################################
+    #                                                                          #
+    #                        K N O W N   D A T A S E T                         #
+    #                                                                          #
+    ############################################################################
+
+    def knownDataset(self, dataset):
+        """
+        _knownDataset_
+
+        Check if dataset is in the Dataset table, all datasets in it have been
+        resolved by PhEDEx
+
+        Arguments:
+        dataset -- Name of dataset, None is never known
+        """
+        if not dataset:
+            return False
+        if dataset in self.dataset_ids:
+            return True
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute('SELECT DatasetId FROM Dataset WHERE Name=?', (dataset,))
+                row = cur.fetchone()
+        except lite.Error:
+            self.logger.error(self.name, "Exception while querying database")
+            return False
+        if not row:
+            return False
+        self.dataset_ids[dataset] = row[0]
+        return True
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  H O U R                                 #
+    #                                                                          #
+    ############################################################################
+
+    def hour(self, hours_ago=0):
+        """
+        _hour_
+
+        Hour bucket of now, or of the given number of hours ago
+        """
+        return int(time.time() // 3600) - hours_ago
+
+
     ############################################################################
     #                                                                          #
     #                              D A T A S E T S                             #
     #                                                                          #
     ############################################################################
 
-    def datasets(self):
+    def datasets(self, hours=24):
         """
         _datasets_
 
-        Get all unique datasets in database
+        Get all unique datasets accessed in the last hours
         """
+        datasets = []
         try:
             with self.connection:
                 cur = self.connection.cursor()
-                cur.execute("SELECT DISTINCT Dataset FROM DatasetAccess")
-                datasets = []
+                cur.execute("SELECT DISTINCT Name FROM DatasetAccessCount NATURAL JOIN Dataset WHERE Hour>?", (self.hour(hours),))
                 for dataset in cur:
                     datasets.append(dataset[0])
-        except lite.IntegrityError:
+        except lite.Error:
             self.logger.error(self.name, "Exception while querying database")
         return datasets
 
@@ -212,24 +411,120 @@ class DynDTADatabase():
     #                                                                          #
     ############################################################################
 
-    def accessCount(self, dataset):
+    def accessCount(self, dataset, hours=24):
         """
         _accessCount_
 
-        Get the number of accesses for the given set
+        Get the number of accesses for the given set in the last hours
 
         Arguments:
         dataset -- Name of dataset
+        hours   -- Size of time window in hours
         """
         try:
             with self.connection:
                 cur = self.connection.cursor()
-                cur.execute("SELECT Dataset FROM DatasetAccess WHERE Dataset=?", (dataset,))
-                count = len(cur.fetchall())
-        except lite.IntegrityError:
+                cur.execute("SELECT SUM(Count) FROM DatasetAccessCount NATURAL JOIN Dataset WHERE Name=? AND Hour>?", (dataset, self.hour(hours)))
+                count = cur.fetchone()[0]
+        except lite.Error:
             self.logger.error(self.name, "Exception while querying database")
             return 0
-        return count
+        return count or 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                         A C C E S S   C O U N T S                        #
+    #                                                                          #
+    ############################################################################
+
+    def accessCounts(self, hours=24):
+        """
+        _accessCounts_
+
+        Get the number of accesses for all sets in the last hours
+
+        Arguments:
+        hours -- Size of time window in hours
+
+        Return values:
+        counts -- Dictionary dataset -> number of accesses
+        """
+        counts = dict()
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute("SELECT Name, SUM(Count) FROM DatasetAccessCount NATURAL JOIN Dataset WHERE Hour>? GROUP BY DatasetId", (self.hour(hours),))
+                counts = dict(cur.fetchall())
+        except lite.Error:
+            self.logger.error(self.name, "Exception while querying database")
+        return counts
+
+
+    ############################################################################
+    #                                                                          #
+    #                          T O P   D A T A S E T S                         #
+    #                                                                          #
+    ############################################################################
+
+    def topDatasets(self, n=100, hours=24):
+        """
+        _topDatasets_
+
+        Get the n most accessed datasets in the last hours
+
+        Arguments:
+        n     -- Number of datasets
+        hours -- Size of time window in hours
+
+        Return values:
+        top -- List of (dataset, number of accesses), most accessed first
+        """
+        top = []
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute("SELECT Name, SUM(Count) AS Total FROM DatasetAccessCount NATURAL JOIN Dataset WHERE Hour>? GROUP BY DatasetId ORDER BY Total DESC LIMIT ?", (self.hour(hours), n))
+                top = cur.fetchall()
+        except lite.Error:
+            self.logger.error(self.name, "Exception while querying database")
+        return top
+
+
+    ############################################################################
+    #                                                                          #
+    #                          D A I L Y   S E R I E S                         #
+    #                                                                          #
+    ############################################################################
+
+    def dailySeries(self, datasets, days=30):
+        """
+        _dailySeries_
+
+        Get the number of accesses per day of several datasets
+
+        Days are in local time, days without accesses are left out.
+
+        Arguments:
+        datasets -- Names of datasets
+        days     -- Number of days to get
+
+        Return values:
+        series -- Dictionary dataset -> list of (YYYYMMDD, number of accesses)
+        """
+        series = dict()
+        datasets = list(datasets)
+        if not datasets:
+            return series
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute("SELECT Name, strftime('%%Y%%m%%d', Hour*3600, 'unixepoch', 'localtime') AS Day, SUM(Count) FROM DatasetAccessCount NATURAL JOIN Dataset WHERE Hour>? AND Name IN (%s) GROUP BY DatasetId, Day ORDER BY Day" % (','.join('?'*len(datasets)),), [self.hour(24*days)] + datasets)
+                for dataset, day, count in cur:
+                    series.setdefault(dataset, []).append((day, count))
+        except lite.Error:
+            self.logger.error(self.name, "Exception while querying database")
+        return series
 
 
     ############################################################################
@@ -238,18 +533,20 @@ class DynDTADatabase():
     #                                                                          #
     ############################################################################
 
-    def cleanAccess(self):
+    def cleanAccess(self, hours=24):
         """
         _cleanAccess_
 
-        Delete all entries in the DatasetAccess table which have expired
-        See insertDataset for expiration time
+        Delete all access counters older than hours
+
+        Arguments:
+        hours -- How many hours of counters to keep
         """
         try:
             with self.connection:
                 cur = self.connection.cursor()
-                cur.execute('DELETE FROM DatasetAccess WHERE Expiration<?', (datetime.datetime.now(),))
-        except lite.IntegrityError:
+                cur.execute('DELETE FROM DatasetAccessCount WHERE Hour<=?', (self.hour(hours),))
+        except lite.Error:
             self.logger.error(self.name, "Exception while deleting data")
         return 0
 
@@ -266,10 +563,10 @@ if __name__ == '__main__':
 
     For testing purpose only
     """
-    db = DYNDTADatabase()
+    db = DynDTADatabase()
     #db.insertDataset("SET2")
     #db.insertDirectory("DIR1", "SET2")
-    #check, datasets = db.datasets()
+    #datasets = db.datasets()
     #for dataset in datasets:
     #    print dataset
     #    count = db.accessCount(dataset)
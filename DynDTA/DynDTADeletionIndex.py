@@ -0,0 +1,219 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTADeletionIndex_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import time
+import sqlite3 as lite
+
+from DynDTALogger import DynDTALogger
+from PhEDExAPI    import PhEDExAPI
+
+
+################################################################################
+#                                                                              #
+#                  D Y N D T A   D E L E T I O N   I N D E X                   #
+#                                                                              #
+################################################################################
+
+class DynDTADeletionIndex:
+    """
+    _DynDTADeletionIndex_
+
+    Recent deletion history of datasets at our sites.
+
+    Deletions are stored in the database together with the time each site was
+    last synchronized, only deletions requested since then are downloaded. A
+    deletion only shows up once it is approved, so each download overlaps the
+    previous sync to catch deletions requested before it but approved after.
+    The index is kept in memory so lookups don't cost any PhEDEx calls.
+
+    Class variables:
+    name       -- ID used when logging
+    logger     -- Used to print log and error messages to log file
+    phedex_api -- Used to download deletions
+    connection -- Established connection to the database
+    window     -- Deletions older than this many seconds are forgotten
+    overlap    -- Seconds each download overlaps the previous sync
+    deletions  -- dataset -> set of sites it was deleted from
+    """
+    def __init__(self, phedex_api=None, db_path='/home/bockelman/barrefors/db/',
+                 db_file='dyndta.db', days=30, overlap=86400):
+        """
+        __init__
+
+        Establish database connection and set up database
+
+        Keyword arguments:
+        phedex_api -- PhEDExAPI object to reuse, a new one is created if None
+        db_path    -- Path to database file
+        db_file    -- File name of database
+        days       -- How many days of deletions to keep track of
+        overlap    -- Seconds each download overlaps the previous sync
+        """
+        self.name       = "DynDTADeletionIndex"
+        self.logger     = DynDTALogger()
+        self.phedex_api = phedex_api or PhEDExAPI()
+        self.window     = days*86400
+        self.overlap    = overlap
+        self.deletions  = dict()
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+        except OSError, e:
+            # Couldn't create path to db file
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
+            sys.exit(1)
+
+        self.connection = lite.connect(db_path + db_file)
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS DatasetDeletion (Dataset TEXT, Site TEXT, RequestTime REAL, PRIMARY KEY (Dataset, Site))')
+                cur.execute('CREATE TABLE IF NOT EXISTS DeletionSync (Site TEXT PRIMARY KEY, Synced REAL)')
+        except lite.Error:
+            self.logger.error(self.name, "Couldn't initialize database")
+            sys.exit(1)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                B U I L D                                 #
+    #                                                                          #
+    ############################################################################
+
+    def build(self, sites):
+        """
+        _build_
+
+        Download new deletions at all sites concurrently, forget deletions
+        older than the window and load the index
+
+        Keyword arguments:
+        sites -- Sites to keep track of
+
+        Return values:
+        check -- 0 if all went well, 1 if any site couldn't be synchronized
+        data  -- Number of datasets with recent deletions
+        """
+        now = time.time()
+        oldest = now - self.window
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Site, Synced FROM DeletionSync')
+            synced = dict(cur.fetchall())
+
+        def sync(site):
+            since = int(max(synced.get(site, 0) - self.overlap, oldest))
+            return self.phedex_api.deletions(node=site, request_since=since)
+
+        responses = self.phedex_api.callMany(sync, 'site', sites)
+        check = 0
+        rows = []
+        sync_rows = []
+        for site, (error, response) in responses.iteritems():
+            if error:
+                self.logger.error(self.name, "Couldn't get deletions for %s" % (site,))
+                check = 1
+                continue
+            for dataset in response.get('phedex').get('dataset') or []:
+                rows.append((dataset.get('name'), site, self.requestTime(dataset, now)))
+            sync_rows.append((site, now))
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.executemany('INSERT OR REPLACE INTO DatasetDeletion VALUES(?,?,?)', rows)
+                cur.executemany('INSERT OR REPLACE INTO DeletionSync VALUES(?,?)', sync_rows)
+                cur.execute('DELETE FROM DatasetDeletion WHERE RequestTime<?', (oldest,))
+        except lite.Error:
+            self.logger.error(self.name, "Exception while inserting data")
+            check = 1
+        self.load()
+        return check, len(self.deletions)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                 L O A D                                  #
+    #                                                                          #
+    ############################################################################
+
+    def load(self):
+        """
+        _load_
+
+        Load all deletions in the database to memory
+        """
+        self.deletions = dict()
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Dataset, Site FROM DatasetDeletion')
+            for dataset, site in cur:
+                self.deletions.setdefault(dataset, set()).add(site)
+
+
+    ############################################################################
+    #                                                                          #
+    #                        R E Q U E S T   T I M E                           #
+    #                                                                          #
+    ############################################################################
+
+    def requestTime(self, dataset, default):
+        """
+        _requestTime_
+
+        Latest deletion request time of a dataset in a deletions response
+
+        Deletions are listed per dataset or per block, default is used if no
+        request time is found.
+        """
+        times = []
+        for item in [dataset] + (dataset.get('block') or []):
+            for deletion in item.get('deletion') or []:
+                if deletion.get('time_request'):
+                    times.append(float(deletion.get('time_request')))
+        if dataset.get('time_request'):
+            times.append(float(dataset.get('time_request')))
+        if not times:
+            return default
+        return max(times)
+
+
+    ############################################################################
+    #                                                                          #
+    #                              D E L E T E D                               #
+    #                                                                          #
+    ############################################################################
+
+    def deleted(self, dataset, sites):
+        """
+        _deleted_
+
+        Check if dataset was deleted from any of the sites during the window
+        """
+        return not self.deletions.get(dataset, set()).isdisjoint(sites)
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    deletion_index = DynDTADeletionIndex()
+    print deletion_index.build(["T2_US_Nebraska"])
+    sys.exit(0)
@@ -0,0 +1,143 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAJSONStream_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import re
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+################################################################################
+#                                                                              #
+#                         I T E R   J S O N   A R R A Y                        #
+#                                                                              #
+################################################################################
+
+def iterJSONArray(fd, key, fields=None, chunk_size=64*1024):
+    """
+    _iterJSONArray_
+
+    Decode the elements of the first array named key in a JSON document one at
+    a time while it is read from fd. Only one element and one chunk of the
+    document are held in memory at a time.
+
+    The elements are decoded by the regular JSON decoder. An element is only
+    accepted once the comma or bracket following it has been read, otherwise
+    a number split between two chunks would be cut short. An element which
+    isn't complete yet is decoded again once more data have arrived.
+
+    Keyword arguments:
+    fd         -- File like object to read the document from
+    key        -- Name of the array, ex 'block'
+    fields     -- Fields to keep in each element, see project
+    chunk_size -- Number of bytes to read at a time
+
+    Return values:
+    Generator of decoded elements, ValueError is raised if the document is
+    malformed or the array is never found
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"%s"\s*:\s*\[' % (re.escape(key),))
+    element = re.compile(r'[\s,]*')
+    delimiter = re.compile(r'\s*[,\]]')
+    buf = ''
+    eof = False
+    try:
+        # Find the start of the array
+        while True:
+            match = start.search(buf)
+            if match:
+                pos = match.end()
+                break
+            if eof:
+                raise ValueError("No array named %s in document" % (key,))
+            # Keep the tail in case the key is split between two chunks
+            buf = buf[-(len(key) + 16):]
+            chunk = fd.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+        # Decode elements until the end of the array
+        while True:
+            pos = element.match(buf, pos).end()
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    decoded = True
+                except ValueError:
+                    decoded = False
+                if decoded and delimiter.match(buf, end):
+                    pos = end
+                    yield project(obj, fields)
+                    continue
+            if eof:
+                raise ValueError("Array %s ended prematurely" % (key,))
+            if pos > chunk_size:
+                buf = buf[pos:]
+                pos = 0
+            chunk = fd.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+    finally:
+        fd.close()
+
+
+################################################################################
+#                                                                              #
+#                                P R O J E C T                                 #
+#                                                                              #
+################################################################################
+
+def project(obj, fields):
+    """
+    _project_
+
+    Strip obj down to the given fields
+
+    Fields is a dictionary of field name -> sub fields, where sub fields is
+    None to keep the whole value or a dictionary to project the value (or each
+    item if value is a list) further. If fields is None obj is kept as is.
+
+    Keyword arguments:
+    obj    -- Decoded JSON object
+    fields -- Fields to keep, ex {'bytes' : None, 'replica' : {'bytes' : None}}
+    """
+    if fields is None:
+        return obj
+    if type(obj) is list:
+        return [project(item, fields) for item in obj]
+    if type(obj) is not dict:
+        return obj
+    projected = dict()
+    for field, sub_fields in fields.iteritems():
+        if field in obj:
+            projected[field] = project(obj[field], sub_fields)
+    return projected
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    for block in iterJSONArray(sys.stdin, 'block', {'name' : None, 'bytes' : None}):
+        print block
+    sys.exit(0)
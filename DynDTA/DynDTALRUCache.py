@@ -0,0 +1,168 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTALRUCache_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import time
+
+from collections import OrderedDict
+
+
+################################################################################
+#                                                                              #
+#                        D Y N D T A   L R U   C A C H E                       #
+#                                                                              #
+################################################################################
+
+class DynDTALRUCache:
+    """
+    _DynDTALRUCache_
+
+    Bounded in memory cache with time to live.
+
+    When the cache is full the least recently used entry is dropped. Entries
+    older than their time to live are treated as missing.
+
+    Class variables:
+    max_size -- Maximum number of entries
+    ttl      -- Default time to live in seconds
+    entries  -- Key -> (value, expiration), least recently used first
+    hits     -- Number of lookups found in cache
+    misses   -- Number of lookups not found or expired
+    """
+    def __init__(self, max_size=10000, ttl=3600):
+        """
+        __init__
+
+        Set up class constants
+
+        Keyword arguments:
+        max_size -- Maximum number of entries
+        ttl      -- Default time to live in seconds
+        """
+        self.max_size = max_size
+        self.ttl      = ttl
+        self.entries  = OrderedDict()
+        self.hits     = 0
+        self.misses   = 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  G E T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def get(self, key):
+        """
+        _get_
+
+        Look up key
+
+        Return values:
+        check -- 0 if found, 1 if not in cache or expired
+        value -- Cached value
+        """
+        try:
+            value, expiration = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return 1, "Not in cache"
+        if expiration < time.time():
+            self.misses += 1
+            return 1, "Expired"
+        # Move to most recently used
+        self.entries[key] = (value, expiration)
+        self.hits += 1
+        return 0, value
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  P U T                                   #
+    #                                                                          #
+    ############################################################################
+
+    def put(self, key, value, ttl=None):
+        """
+        _put_
+
+        Insert or replace key, drop least recently used entry if cache is full
+
+        Keyword arguments:
+        key   -- Cache key
+        value -- Value to cache
+        ttl   -- Time to live in seconds, default is the cache ttl
+        """
+        if ttl is None:
+            ttl = self.ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.time() + ttl)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                S T A T S                                 #
+    #                                                                          #
+    ############################################################################
+
+    def stats(self):
+        """
+        _stats_
+
+        Get cache counters
+
+        Return values:
+        hits   -- Lookups found in cache
+        misses -- Lookups not found or expired
+        ratio  -- Fraction of lookups found in cache
+        size   -- Number of entries in cache
+        """
+        lookups = self.hits + self.misses
+        ratio = 0.0
+        if lookups:
+            ratio = float(self.hits) / lookups
+        return self.hits, self.misses, ratio, len(self.entries)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        # Doesn't count as a lookup or change the order
+        try:
+            return self.entries[key][1] >= time.time()
+        except KeyError:
+            return False
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    cache = DynDTALRUCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    print cache.get('a'), cache.get('b'), cache.get('c')
+    print "Hits: %d Misses: %d Ratio: %.2f Size: %d" % cache.stats()
+    sys.exit(0)
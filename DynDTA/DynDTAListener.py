@@ -17,15 +17,18 @@ import os
 import time
 import re
 import socket
-import datetime
+import zlib
+import errno
 
-from multiprocessing import Manager, Process, Pool
-from operator        import itemgetter
+from Queue           import Empty, Full, Queue as ThreadQueue
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
 from email.mime.text import MIMEText
 from subprocess      import Popen, PIPE
 
 from DynDTALogger   import DynDTALogger
 from DynDTADatabase import DynDTADatabase
+from DynDTALRUCache import DynDTALRUCache
 from PhEDExAPI       import PhEDExAPI
 from PopDBAPI        import PopDBAPI
 
@@ -67,6 +70,20 @@ class DynDTAListener():
         self.receivers  = "bbarrefo@cse.unl.edu"
         self.graph_path = "/home/bockelman/barrefors/data/"
         self.graph_file = "dyndta.dat"
+        # Seconds before retrying directories PhEDEx couldn't resolve
+        self.unresolved_ttl = 3600
+        self.failed_ttl     = 600
+        # Official LFNs: /store/<type>/<era>/<primary>/<tier>/<processed>/<counter>/<file>
+        self.lfn_types      = set(['data', 'mc', 'hidata', 'himc'])
+        self.processed_re   = re.compile(r'^[\w-]+-v\d+$')
+        # Set up by startPrefetch in worker processes
+        self.prefetch_requests = None
+        self.prefetched        = None
+        # Set up by startResolver in worker processes
+        self.resolver          = None
+        self.resolved          = None
+        self.parked            = dict()
+        self.pending           = []
 
 
     ############################################################################
@@ -81,45 +98,29 @@ class DynDTAListener():
 
         Ran once a day to identify the 100 most popular datasets
         and clean out old entries in the database
+
+        The graph file gets the daily accesses of the 100 most popular datasets
+        during the days kept in the database.
         """
         database = DynDTADatabase()
+        days = 30
         # Run once a day
-        graph_data = dict()
         while True:
             time.sleep(86400)
             self.popdb.renewSSOCookie()
             # Clear entries
-            database.cleanAccess()
-            datasets = database.datasets()
-            set_count = []
-            for dataset in datasets:
-                count = database.accessCount(dataset)
-                set_count.append((count, dataset))
-            # Sort set_count and print out the top N sets w accesses
-            set_count = sorted(set_count, key=itemgetter(0))
-            set_count.reverse()
-            # Get date
-            today = str(datetime.datetime.now().strftime("%Y%m%d"))
+            database.cleanAccess(24*days)
+            top = database.topDatasets(100, 24)
             text = "The 100 most accessed datasets in the last 24h\n\n"
-            i = 1
-            for dataset in set_count:
-                if i <= 100:
-                    text = text + str(i) + ". " + str(dataset[1]) + "\t" + str(dataset[0]) + "\n"
-                # Get previous entry if exist
-                try:
-                    old_data = graph_data[str(dataset[1])]
-                except KeyError:
-                    new_data = [(today, dataset[0])]
-                else:
-                    new_data = old_data.append((today, dataset[0]))
-                graph_data[dataset[1]] = new_data
-                i += 1
+            for i, (dataset, count) in enumerate(top):
+                text = text + str(i + 1) + ". " + str(dataset) + "\t" + str(count) + "\n"
             msg = MIMEText(text)
             msg['Subject'] = "Dataset report from DynDTA"
             msg['From'] = self.sender
             msg['To'] = self.receivers
             p = Popen(["/usr/sbin/sendmail", "-toi"], stdin=PIPE)
             p.communicate(msg.as_string())
+            series = database.dailySeries([dataset for dataset, count in top], days)
             try:
                 if not os.path.isdir(self.graph_path):
                     os.makedirs(self.graph_path)
@@ -132,7 +133,7 @@ class DynDTAListener():
                 # Couldn't create path to log file
                 self.logger.error(self.name, "Couldn\'t create graph file. Reason: %s" % (e,))
                 sys.exit(1)
-            for dataset, data in graph_data.iteritems():
+            for dataset, data in series.iteritems():
                 graph_fd.write(str(dataset) + "\n")
                 for dates in data:
                     graph_fd.write(str(dates[0]) + "\t" + str(dates[1]) + "\n")
@@ -148,35 +149,424 @@ class DynDTAListener():
     #                                                                          #
     ############################################################################
 
-    def dataHandler(self, d, database):
+    def dataHandler(self, d, database, cache):
         """
         _dataHandler_
 
-        Look up dataset of accessed file, first look in database cache, if not
-        found query PhEDEx
+        Look up dataset of accessed file, first look in the in memory cache of
+        the worker, then in database cache, if not found query PhEDEx
+
+        Dataset might not exist in PhEDEx, failed lookups are cached with an
+        empty dataset name for a shorter time so they are not retried for every
+        access
+
+        If the dataset name derived from the LFN is already known PhEDEx is not
+        queried, see derive. Datasets resolved by PhEDEx are prefetched if
+        prefetching is started, see prefetch
 
-        Dataset might not exist in PhEDEx
+        If the resolver is started the access is parked until PhEDEx answers
+        instead of waiting for it, see park
         """
+        if 'file_lfn' not in d:
+            return 1
         lfn = str(d['file_lfn'])
         # Check for invalid sets
         if ((lfn.find("/store", 0, 6) == -1) or (lfn.find("/store/user", 0, 11) == 0) or (lfn.count("/") < 3)):
             return 1
-        directory = lfn.rsplit('/',2)[0]
-        # Check if dir is in cache
-        check, dataset = database.lookup(directory)
-        if check:
-            # If not call PhEDExAPI
-            check, data = self.phedex.data(file_name=lfn, level='file')
-            if check:
+        directory = self.directory(lfn)
+        # Check if dir is in memory
+        check, dataset = cache.get(directory)
+        if not check:
+            if not dataset:
                 return 1
-            data = data.get('phedex').get('dbs')
-            if not data:
+            database.insertDataset(dataset)
+            return 0
+        # Check if dir is in cache
+        check, dataset, ttl = database.lookup(directory)
+        if not check:
+            if not dataset:
+                # Keep the expiration it was stored with, failed lookups expire sooner
+                cache.put(directory, dataset, ttl=ttl)
                 return 1
-            dataset = data[0].get('dataset')[0].get('name')
+        else:
+            # If not try to derive it from the LFN
+            dataset = self.derive(lfn)
+            if not database.knownDataset(dataset):
+                # If not call PhEDExAPI
+                if self.resolver is not None:
+                    self.park(directory, lfn)
+                    return 0
+                return self.credit(self.resolve([(directory, lfn)])[0], 1, database, cache)
             database.insertDirectory(directory, dataset)
+        cache.put(directory, dataset)
         # update access (insertDataset)
         database.insertDataset(dataset)
 
+    ############################################################################
+    #                                                                          #
+    #                        S T A R T   R E S O L V E R                       #
+    #                                                                          #
+    ############################################################################
+
+    def startResolver(self, threads=8):
+        """
+        _startResolver_
+
+        Start the pool of threads resolving directories with PhEDEx, must be
+        called in the process using it
+
+        Keyword arguments:
+        threads -- Number of concurrent PhEDEx lookups
+        """
+        self.resolved = ThreadQueue()
+        self.resolver = ThreadPool(threads)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  P A R K                                 #
+    #                                                                          #
+    ############################################################################
+
+    def park(self, directory, lfn):
+        """
+        _park_
+
+        Park an access to a directory which needs to be resolved by PhEDEx
+
+        Only the first access to a directory is queued for lookup, later
+        accesses are counted and wait for the same answer. Lookups are sent by
+        dispatch and accesses are credited by storeResolved.
+
+        Keyword arguments:
+        directory -- Directory of accessed file
+        lfn       -- Accessed file
+        """
+        if directory in self.parked:
+            self.parked[directory] += 1
+            return
+        self.parked[directory] = 1
+        self.pending.append((directory, lfn))
+
+
+    ############################################################################
+    #                                                                          #
+    #                              D I S P A T C H                             #
+    #                                                                          #
+    ############################################################################
+
+    def dispatch(self):
+        """
+        _dispatch_
+
+        Send all queued lookups to the resolver as one batch
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        self.resolver.apply_async(self.resolve, (pending,), callback=self.resolved.put)
+
+
+    ############################################################################
+    #                                                                          #
+    #                               R E S O L V E                              #
+    #                                                                          #
+    ############################################################################
+
+    def resolve(self, pending):
+        """
+        _resolve_
+
+        Look up datasets of files in PhEDEx, many files per call. May run in a
+        resolver thread so the database and cache are not used
+
+        Keyword arguments:
+        pending -- List of (directory, lfn) to look up
+
+        Return values:
+        results -- List of (directory, check, dataset), check is 0 if resolved,
+                   1 if PhEDEx call failed and 2 if file unknown
+        """
+        results = []
+        try:
+            responses = self.phedex.dataBatch(key='file_name', values=[lfn for directory, lfn in pending], level='file')
+            for directory, lfn in pending:
+                check, data = responses[lfn]
+                if check:
+                    results.append((directory, 1, ''))
+                    continue
+                data = data.get('phedex').get('dbs')
+                if not data:
+                    results.append((directory, 2, ''))
+                    continue
+                results.append((directory, 0, data[0].get('dataset')[0].get('name')))
+        except Exception, e:
+            # A lost result would leave the directories parked forever
+            self.logger.error(self.name, "Couldn't resolve %d files. Reason: %s" % (len(pending), e))
+            done = set(result[0] for result in results)
+            results.extend((directory, 1, '') for directory, lfn in pending if directory not in done)
+        return results
+
+
+    ############################################################################
+    #                                                                          #
+    #                                C R E D I T                               #
+    #                                                                          #
+    ############################################################################
+
+    def credit(self, result, count, database, cache):
+        """
+        _credit_
+
+        Store a resolved directory and count its accesses
+
+        Keyword arguments:
+        result   -- (directory, check, dataset) from resolve
+        count    -- Number of accesses to the directory
+        database -- Database of the worker
+        cache    -- In memory cache of the worker
+        """
+        directory, check, dataset = result
+        if check == 1:
+            # PhEDEx might be down, try again sooner
+            self.unresolved(directory, database, cache, self.failed_ttl)
+            return 1
+        if check:
+            self.unresolved(directory, database, cache, self.unresolved_ttl)
+            return 1
+        self.prefetch(dataset)
+        database.insertDirectory(directory, dataset)
+        cache.put(directory, dataset)
+        database.insertDataset(dataset, count)
+        return 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                        S T O R E   R E S O L V E D                       #
+    #                                                                          #
+    ############################################################################
+
+    def storeResolved(self, database, cache):
+        """
+        _storeResolved_
+
+        Credit the parked accesses of all directories resolved since last call
+
+        Keyword arguments:
+        database -- Database of the worker
+        cache    -- In memory cache of the worker
+        """
+        if self.resolved is None:
+            return
+        while True:
+            try:
+                results = self.resolved.get_nowait()
+            except Empty:
+                return
+            for result in results:
+                self.credit(result, self.parked.pop(result[0], 0), database, cache)
+
+
+    ############################################################################
+    #                                                                          #
+    #                               D E R I V E                                #
+    #                                                                          #
+    ############################################################################
+
+    def derive(self, lfn):
+        """
+        _derive_
+
+        Derive dataset name from the path of an official LFN
+
+        /store/data/Run2012A/MET/AOD/22Jan2013-v1/30000/<file> belongs to
+        /MET/Run2012A-22Jan2013-v1/AOD, mc follows the same structure
+
+        Keyword arguments:
+        lfn -- Logical file name
+
+        Return values:
+        dataset -- Derived dataset name, None if the LFN doesn't follow the
+                   structure
+        """
+        parts = lfn.split('/')
+        if (len(parts) < 9) or (parts[2] not in self.lfn_types):
+            return None
+        era, primary, tier, processed = parts[3:7]
+        if not (era and primary and tier and self.processed_re.match(processed)):
+            return None
+        return "/%s/%s-%s/%s" % (primary, era, processed, tier)
+
+
+    ############################################################################
+    #                                                                          #
+    #                        S T A R T   P R E F E T C H                       #
+    #                                                                          #
+    ############################################################################
+
+    def startPrefetch(self, requests):
+        """
+        _startPrefetch_
+
+        Send datasets resolved by this worker to the prefetch process, see
+        prefetchWork
+
+        Keyword arguments:
+        requests -- Queue read by the prefetch process
+        """
+        self.prefetch_requests = requests
+        # Don't send the same dataset again while its directories are cached
+        self.prefetched        = DynDTALRUCache(max_size=10000, ttl=86400)
+
+
+    ############################################################################
+    #                                                                          #
+    #                               P R E F E T C H                            #
+    #                                                                          #
+    ############################################################################
+
+    def prefetch(self, dataset):
+        """
+        _prefetch_
+
+        Queue dataset to have the directories of all its files looked up by the
+        prefetch process
+
+        Nothing is done if prefetching isn't started or dataset was recently
+        prefetched, the dataset is skipped if the prefetch process is behind
+
+        Keyword arguments:
+        dataset -- Name of dataset
+        """
+        if self.prefetch_requests is None:
+            return
+        check, data = self.prefetched.get(dataset)
+        if not check:
+            return
+        self.prefetched.put(dataset, True)
+        try:
+            self.prefetch_requests.put_nowait(dataset)
+        except Full:
+            pass
+
+
+    ############################################################################
+    #                                                                          #
+    #                  P R E F E T C H   D I R E C T O R I E S                 #
+    #                                                                          #
+    ############################################################################
+
+    def prefetchDirectories(self, dataset):
+        """
+        _prefetchDirectories_
+
+        Look up the directories of all files of dataset, one PhEDEx call
+
+        Return values:
+        check       -- 0 if all went well, 1 if error occured
+        directories -- Set of directories
+        """
+        check, data = self.phedex.data(dataset=dataset, level='file')
+        if check:
+            return 1, "Error"
+        directories = set()
+        try:
+            for block in data.get('phedex').get('dbs')[0].get('dataset')[0].get('block') or []:
+                for lfn_file in block.get('file') or []:
+                    directories.add(self.directory(str(lfn_file.get('lfn'))))
+        except (IndexError, AttributeError, TypeError):
+            self.logger.error(self.name, "Couldn't get files of %s" % (dataset,))
+            return 1, "Error"
+        return 0, directories
+
+
+    ############################################################################
+    #                                                                          #
+    #                       S T O R E   P R E F E T C H E D                    #
+    #                                                                          #
+    ############################################################################
+
+    def storePrefetched(self, database, dataset, directories):
+        """
+        _storePrefetched_
+
+        Insert prefetched directories of dataset in the database, directories
+        already stored for the dataset are not written again
+
+        Keyword arguments:
+        database    -- Database of the prefetch process
+        dataset     -- Name of dataset
+        directories -- Directories of the files of dataset
+        """
+        for directory in directories:
+            check, known, ttl = database.lookup(directory)
+            if check or (known != dataset):
+                database.insertDirectory(directory, dataset)
+        database.flush()
+
+
+    ############################################################################
+    #                                                                          #
+    #                           U N R E S O L V E D                            #
+    #                                                                          #
+    ############################################################################
+
+    def unresolved(self, directory, database, cache, ttl):
+        """
+        _unresolved_
+
+        Cache a directory which couldn't be resolved to a dataset
+
+        Keyword arguments:
+        directory -- Directory which couldn't be resolved
+        database  -- Database of the worker
+        cache     -- In memory cache of the worker
+        ttl       -- Seconds until the directory is looked up again
+        """
+        database.insertDirectory(directory, '', hours=ttl/3600.0)
+        cache.put(directory, '', ttl=ttl)
+
+
+    ############################################################################
+    #                                                                          #
+    #                            D I R E C T O R Y                             #
+    #                                                                          #
+    ############################################################################
+
+    def directory(self, lfn):
+        """
+        _directory_
+
+        Directory used as cache key for the dataset of a file
+        """
+        return lfn.rsplit('/',2)[0]
+
+    ############################################################################
+    #                                                                          #
+    #                                S H A R D                                 #
+    #                                                                          #
+    ############################################################################
+
+    def shard(self, data, n_shards):
+        """
+        _shard_
+
+        Pick which worker handles a UDP packet.
+
+        Packets are split on the directory of the accessed file so all accesses
+        to a directory go to the same worker and its cache. Only the file_lfn
+        line is looked at, the rest of the packet is parsed by the worker.
+        """
+        start = data.find('file_lfn=')
+        if start == -1:
+            return 0
+        end = data.find('\n', start)
+        if end == -1:
+            end = len(data)
+        lfn = data[start+9:end].strip()
+        return zlib.crc32(self.directory(lfn)) % n_shards
+
     ############################################################################
     #                                                                          #
     #                                P A R S E                                 #
@@ -203,18 +593,199 @@ class DynDTAListener():
 #                                                                              #
 ################################################################################
 
-def work(q):
+def work(q, shard, n_shards, prefetch=None, resolvers=8):
     """
     _work_
 
-    Distribute data handling of UDP packets to worker processes.
+    Handle the UDP packets of one shard, each worker process have its own
+    queue, database connection and in memory directory cache. Packets arrive
+    in batches.
+
+    The cache is warmed up with the directories of this shard already in the
+    database. Cache statistics are logged every 10 minutes. Database writes are
+    buffered, they are flushed also when no packets arrive.
+
+    Accesses to directories which need PhEDEx are parked and credited when a
+    resolver thread has the answer, so counting never waits for PhEDEx.
+
+    A packet which can't be handled is logged and skipped, an error in one
+    packet or a locked database must not stop the worker.
+
+    Keyword arguments:
+    q         -- Queue of packet batches for this worker
+    shard     -- Shard handled by this worker
+    n_shards  -- Total number of shards
+    prefetch  -- Queue of the prefetch process, None to not prefetch
+    resolvers -- Number of resolver threads, 0 to wait for PhEDEx
+    """
+    global listener
+    database = DynDTADatabase()
+    cache = DynDTALRUCache(max_size=100000, ttl=3600)
+    for directory, dataset in database.directories():
+        if zlib.crc32(directory) % n_shards == shard:
+            cache.put(directory, dataset)
+    listener.logger.log(listener.name, "Worker %d cache warmed up with %d directories" % (shard, len(cache)))
+    if prefetch is not None:
+        listener.startPrefetch(prefetch)
+    if resolvers:
+        listener.startResolver(resolvers)
+
+    report = time.time() + 600
+    while True:
+        try:
+            batch = q.get(timeout=database.flush_ms/1000.0)
+        except Empty:
+            try:
+                listener.storeResolved(database, cache)
+                database.flush()
+            except Exception, e:
+                listener.logger.error(listener.name, "Worker %d couldn't store batch. Reason: %s" % (shard, str(e)))
+            continue
+        for data in batch:
+            try:
+                listener.dataHandler(listener.parse(data), database, cache)
+            except Exception, e:
+                listener.logger.error(listener.name, "Worker %d couldn't handle packet. Reason: %s" % (shard, str(e)))
+        try:
+            listener.dispatch()
+            listener.storeResolved(database, cache)
+            database.flushDue()
+        except Exception, e:
+            listener.logger.error(listener.name, "Worker %d couldn't store batch. Reason: %s" % (shard, str(e)))
+        if time.time() > report:
+            listener.logger.log(listener.name, "Worker %d cache hits: %d misses: %d ratio: %.3f size: %d" % ((shard,) + cache.stats()))
+            report = time.time() + 600
+
+
+################################################################################
+#                                                                              #
+#                           P R E F E T C H   W O R K                          #
+#                                                                              #
+################################################################################
+
+def prefetchWork(requests):
+    """
+    _prefetchWork_
+
+    Look up all directories of datasets newly resolved by the workers and
+    store them in the database, where the workers find them on their next
+    lookup.
+
+    All workers send their datasets to this one process so each dataset is
+    fetched from PhEDEx once, datasets fetched in the last 24 hours are
+    skipped. A dataset which couldn't be fetched is tried again next time a
+    worker sends it.
+
+    Keyword arguments:
+    requests -- Queue of dataset names from the workers
     """
     global listener
-    database = CMSDATADatabase()
+    database = DynDTADatabase()
+    fetched = DynDTALRUCache(max_size=100000, ttl=86400)
+    while True:
+        dataset = requests.get()
+        if dataset in fetched:
+            continue
+        try:
+            check, directories = listener.prefetchDirectories(dataset)
+            if check:
+                continue
+            listener.storePrefetched(database, dataset, directories)
+            fetched.put(dataset, True)
+        except Exception, e:
+            listener.logger.error(listener.name, "Couldn't prefetch %s. Reason: %s" % (dataset, str(e)))
+
+
+################################################################################
+#                                                                              #
+#                               R E C E I V E                                  #
+#                                                                              #
+################################################################################
+
+def receive(queues, port=9345, batch_size=256, rcvbuf=32*1024*1024):
+    """
+    _receive_
+
+    Receive UDP packets and forward them in batches to the workers.
 
+    Several receivers bind the same port with SO_REUSEPORT and the kernel
+    spreads packets between them. Each wakeup drains up to batch_size packets
+    without blocking before they are sharded and handed to the workers, one
+    queue put per worker and batch. If a worker queue is full the batch is
+    dropped rather than blocking all shards, drops are logged every 10 minutes.
+
+    Keyword arguments:
+    queues     -- Worker queues, one per shard
+    port       -- UDP port to listen on
+    batch_size -- Maximum number of packets to read per wakeup
+    rcvbuf     -- Requested size of the kernel receive buffer
+    """
+    global listener
+
+    # UDP packets containing information about file access
+    UDPSock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    # Not all Python 2 builds define SO_REUSEPORT, 15 on Linux
+    UDPSock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    UDPSock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    listen_addr = ("0.0.0.0", port)
+    UDPSock.bind(listen_addr)
+    buf = 64*1024
+    n_shards = len(queues)
+    dropped = 0
+    report = time.time() + 600
+    # Listen for UDP packets
     while True:
-        data = q.get()
-        listener.dataHandler(listener.parse(data), database)
+        batches = [[] for queue in queues]
+        data,addr = UDPSock.recvfrom(buf)
+        batches[listener.shard(data, n_shards)].append(data)
+        for i in xrange(batch_size - 1):
+            try:
+                data,addr = UDPSock.recvfrom(buf, socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            batches[listener.shard(data, n_shards)].append(data)
+        for queue, batch in zip(queues, batches):
+            if batch:
+                try:
+                    queue.put_nowait(batch)
+                except Full:
+                    dropped += len(batch)
+        if dropped and (time.time() > report):
+            listener.logger.error(listener.name, "Worker queues full, dropped %d packets in last 10 min" % (dropped,))
+            dropped = 0
+            report = time.time() + 600
+
+
+################################################################################
+#                                                                              #
+#                             U D P   D R O P S                                #
+#                                                                              #
+################################################################################
+
+def udpDrops(port=9345):
+    """
+    _udpDrops_
+
+    Number of packets the kernel dropped for all sockets bound to port, read
+    from the drops column of /proc/net/udp.
+    """
+    drops = 0
+    try:
+        udp_fd = open('/proc/net/udp')
+    except IOError:
+        return 0
+    udp_fd.readline()
+    for line in udp_fd:
+        fields = line.split()
+        try:
+            if int(fields[1].split(':')[1], 16) == port:
+                drops += int(fields[-1])
+        except (IndexError, ValueError):
+            continue
+    udp_fd.close()
+    return drops
 
 
 ################################################################################
@@ -223,34 +794,114 @@ def work(q):
 #                                                                              #
 ################################################################################
 
-def listen():
+def startWorker(queue, shard, n_shards, prefetch):
+    """
+    _startWorker_
+
+    Start a worker process for one shard
+
+    Return values:
+    worker -- Started worker process
+    """
+    worker = Process(target=work, args=(queue, shard, n_shards, prefetch))
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def startReceiver(queues, port):
+    """
+    _startReceiver_
+
+    Start a receiver process feeding the worker queues
+
+    Return values:
+    receiver -- Started receiver process
+    """
+    receiver = Process(target=receive, args=(queues, port))
+    receiver.daemon = True
+    receiver.start()
+    return receiver
+
+
+def startPrefetcher(requests):
+    """
+    _startPrefetcher_
+
+    Start the prefetch process shared by all workers
+
+    Return values:
+    prefetcher -- Started prefetch process
+    """
+    prefetcher = Process(target=prefetchWork, args=(requests,))
+    prefetcher.daemon = True
+    prefetcher.start()
+    return prefetcher
+
+
+def listen(n_workers=4, n_receivers=2, port=9345, queue_size=1000):
     """
     _listen_
 
-    Spawn worker processes.
-    Listen for UDP packets and send to parser and then distribute to workers.
+    Spawn worker and receiver processes.
+    Receivers listen for UDP packets and distribute them to workers, sharded
+    on the directory of the accessed file.
+    One prefetch process looks up the directories of datasets resolved by any
+    worker.
+    Workers which die are restarted on the same queue, receivers which die are
+    restarted on the same port and the prefetch process is restarted too.
+    Log the number of packets dropped by the kernel every 10 minutes.
+
+    Keyword arguments:
+    n_workers   -- Number of worker processes
+    n_receivers -- Number of receiver processes
+    port        -- UDP port to listen on
+    queue_size  -- Maximum number of packet batches waiting for each worker
     """
     global listener
 
+    # Spawn the prefetch process shared by all workers
+    prefetch = Queue(maxsize=queue_size)
+    prefetcher = startPrefetcher(prefetch)
+
     # Spawn worker processes that will parse data and insert into database
-    pool = Pool(processes=4)
-    manager = Manager()
-    queue = manager.Queue()
+    queues = []
+    workers = []
+    for i in range(n_workers):
+        queue = Queue(maxsize=queue_size)
+        workers.append(startWorker(queue, i, n_workers, prefetch))
+        queues.append(queue)
 
     # Spawn process o clean out database and make reports every 1h
     process = Process(target=listener.routine, args=())
     process.start()
-    workers = pool.apply_async(work, (queue,))
 
-    # UDP packets containing information about file access
-    UDPSock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-    listen_addr = ("0.0.0.0", 9345)
-    UDPSock.bind(listen_addr)
-    buf = 64*1024
-    # Listen for UDP packets
+    # Spawn receivers sharing the port
+    receivers = []
+    for i in range(n_receivers):
+        receivers.append(startReceiver(queues, port))
+
+    # Keep workers, receivers and prefetcher alive and track packet loss
+    drops = udpDrops(port)
+    report = time.time() + 600
     while True:
-        data,addr = UDPSock.recvfrom(buf)
-        queue.put(data)
+        time.sleep(10)
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                listener.logger.error(listener.name, "Worker %d died with exit code %s, restarting" % (i, str(worker.exitcode)))
+                workers[i] = startWorker(queues[i], i, n_workers, prefetch)
+        for i, receiver in enumerate(receivers):
+            if not receiver.is_alive():
+                listener.logger.error(listener.name, "Receiver %d died with exit code %s, restarting" % (i, str(receiver.exitcode)))
+                receivers[i] = startReceiver(queues, port)
+        if not prefetcher.is_alive():
+            listener.logger.error(listener.name, "Prefetcher died with exit code %s, restarting" % (str(prefetcher.exitcode),))
+            prefetcher = startPrefetcher(prefetch)
+        if time.time() > report:
+            total = udpDrops(port)
+            listener.logger.log(listener.name, "UDP packets dropped: %d in last 10 min, %d total" % (total - drops, total))
+            drops = total
+            report = time.time() + 600
     #finally:
         #Close everything if program is interupted
         #UDPSock.close()
@@ -272,4 +923,10 @@ if __name__ == '__main__':
 
     This is where it all starts.
     """
-    sys.exit(listen())
+    n_workers = 4
+    n_receivers = 2
+    if len(sys.argv) >= 2:
+        n_workers = int(sys.argv[1])
+    if len(sys.argv) >= 3:
+        n_receivers = int(sys.argv[2])
+    sys.exit(listen(n_workers=n_workers, n_receivers=n_receivers))
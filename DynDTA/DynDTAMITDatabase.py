@@ -0,0 +1,252 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAMITDatabase_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import time
+import base64
+import sqlite3 as lite
+import MySQLdb as msdb
+
+from DynDTALogger import DynDTALogger
+
+
+################################################################################
+#                                                                              #
+#                     D Y N D T A   M I T   D A T A B A S E                    #
+#                                                                              #
+################################################################################
+
+class DynDTAMITDatabase:
+    """
+    _DynDTAMITDatabase_
+
+    Access to the MySQL database at MIT.
+
+    The connection is opened when first needed, reused for all queries and
+    opened again if it was dropped. Site quotas rarely change so they are kept
+    in the local database and only fetched from MIT once they are older than
+    refresh, if MIT can't be reached the local quotas are used.
+
+    Class variables:
+    name       -- ID used when logging
+    logger     -- Used to print log and error messages to log file
+    login_file -- File with base64 encoded host, db, user and password
+    connection -- Connection to MIT, None if not connected
+    local      -- Connection to the local database
+    refresh    -- Seconds before quotas are fetched again
+    Error      -- Exception raised by failing MySQL queries
+    """
+    Error = msdb.Error
+
+    def __init__(self, login_file='/home/bockelman/barrefors/db/login',
+                 db_path='/home/bockelman/barrefors/db/', db_file='dyndta.db',
+                 refresh=86400):
+        """
+        __init__
+
+        Establish local database connection and set up local database
+
+        Keyword arguments:
+        login_file -- File with base64 encoded host, db, user and password
+        db_path    -- Path to local database file
+        db_file    -- File name of local database
+        refresh    -- Seconds before quotas are fetched again
+        """
+        self.name       = "DynDTAMITDatabase"
+        self.logger     = DynDTALogger()
+        self.login_file = login_file
+        self.connection = None
+        self.refresh    = refresh
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+        except OSError, e:
+            # Couldn't create path to db file
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
+            sys.exit(1)
+
+        self.local = lite.connect(db_path + db_file)
+        try:
+            with self.local:
+                cur = self.local.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS SiteQuota (SiteName TEXT, GroupName TEXT, SizeTb REAL, Updated REAL, PRIMARY KEY (SiteName, GroupName))')
+        except lite.Error:
+            self.logger.error(self.name, "Couldn't initialize database")
+            sys.exit(1)
+
+
+    ############################################################################
+    #                                                                          #
+    #                               C O N N E C T                              #
+    #                                                                          #
+    ############################################################################
+
+    def connect(self):
+        """
+        _connect_
+
+        Connect to the MySQL DB at MIT, raises Error if it fails
+        """
+        # Get server, username, and password from file
+        db_file = open(self.login_file)
+        host = db_file.readline().strip()
+        db = db_file.readline().strip()
+        user = db_file.readline().strip()
+        passwd = db_file.readline().strip()
+        db_file.close()
+        # Decode the address, username, and password
+        host = base64.b64decode(host)
+        db = base64.b64decode(db)
+        user = base64.b64decode(user)
+        passwd = base64.b64decode(passwd)
+        # Connect to DB
+        self.connection = msdb.connect(host=host, user=user, passwd=passwd, db=db)
+        return 0
+
+
+    ############################################################################
+    #                                                                          #
+    #                                C U R S O R                               #
+    #                                                                          #
+    ############################################################################
+
+    def cursor(self):
+        """
+        _cursor_
+
+        Get a cursor on a live connection, connecting again if the connection
+        was dropped. Raises Error if MIT can't be reached.
+        """
+        if self.connection is not None:
+            try:
+                self.connection.ping()
+            except msdb.Error:
+                self.logger.log(self.name, "Connection dropped, reconnecting")
+                self.close()
+        if self.connection is None:
+            self.connect()
+        return self.connection.cursor()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                C O M M I T                               #
+    #                                                                          #
+    ############################################################################
+
+    def commit(self):
+        """
+        _commit_
+
+        Commit the current transaction
+        """
+        self.connection.commit()
+
+
+    def rollback(self):
+        """
+        _rollback_
+
+        Roll back the current transaction
+        """
+        self.connection.rollback()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                 C L O S E                                #
+    #                                                                          #
+    ############################################################################
+
+    def close(self):
+        """
+        _close_
+
+        Close the connection to MIT, it is opened again when needed
+        """
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except msdb.Error:
+            pass
+        self.connection = None
+
+
+    ############################################################################
+    #                                                                          #
+    #                               Q U O T A S                                #
+    #                                                                          #
+    ############################################################################
+
+    def quotas(self, sites, group='AnalysisOps'):
+        """
+        _quotas_
+
+        Get quotas of group at sites in TB
+
+        Missing and old quotas are fetched from MIT in one query and stored
+        locally, the rest come from the local database.
+
+        Keyword arguments:
+        sites -- Names of sites
+        group -- Group owning the quota
+
+        Return values:
+        quotas -- Dictionary site -> TB, sites without quota are left out
+        """
+        now = time.time()
+        with self.local:
+            cur = self.local.cursor()
+            cur.execute('SELECT SiteName, SizeTb, Updated FROM SiteQuota WHERE GroupName=?', (group,))
+            cached = dict((site, (size, updated)) for site, size, updated in cur)
+        stale = [site for site in set(sites) if (site not in cached) or (now - cached[site][1] > self.refresh)]
+        if stale:
+            try:
+                cur = self.cursor()
+                try:
+                    cur.execute("SELECT SiteName, SizeTb FROM Quotas WHERE GroupName=%%s AND SiteName IN (%s)" % (', '.join(['%s']*len(stale)),), [group] + stale)
+                    fetched = cur.fetchall()
+                finally:
+                    cur.close()
+            except (msdb.Error, IOError), e:
+                self.logger.error(self.name, "Couldn't fetch quotas, using local quotas. Reason: %s" % (str(e),))
+            else:
+                fetched = dict((site, float(size)) for site, size in fetched)
+                removed = [(site, group) for site in stale if site not in fetched]
+                with self.local:
+                    cur = self.local.cursor()
+                    cur.executemany('INSERT OR REPLACE INTO SiteQuota VALUES(?,?,?,?)', [(site, group, size, now) for site, size in fetched.iteritems()])
+                    cur.executemany('DELETE FROM SiteQuota WHERE SiteName=? AND GroupName=?', removed)
+                for site, group in removed:
+                    cached.pop(site, None)
+                for site, size in fetched.iteritems():
+                    cached[site] = (size, now)
+        return dict((site, cached[site][0]) for site in sites if site in cached)
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    mit_db = DynDTAMITDatabase()
+    print mit_db.quotas(["T2_US_Nebraska", "T2_US_MIT"])
+    mit_db.close()
+    sys.exit(0)
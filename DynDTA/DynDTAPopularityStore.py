@@ -0,0 +1,271 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAPopularityStore_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import time
+import datetime
+import numpy
+import sqlite3 as lite
+
+from DynDTALogger import DynDTALogger
+from PopDBAPI     import PopDBAPI
+
+
+################################################################################
+#                                                                              #
+#                D Y N D T A   P O P U L A R I T Y   S T O R E                 #
+#                                                                              #
+################################################################################
+
+class DynDTAPopularityStore:
+    """
+    _DynDTAPopularityStore_
+
+    Local store of daily Popularity DB statistics per dataset.
+
+    Each day is downloaded once, recent days may still change in the
+    Popularity DB so they are downloaded again until they are settle_days old.
+    Statistics for any time window are summed locally from the days.
+
+    Class variables:
+    name        -- ID used when logging
+    logger      -- Used to print log and error messages to log file
+    pop_db_api  -- Used to download daily statistics
+    connection  -- Established connection to the database
+    settle_days -- Days are downloaded again until they are this old
+    refresh     -- Seconds before a day which hasn't settled is downloaded again
+    METRICS     -- Popularity DB field -> column of stored statistics
+    """
+    METRICS = [('NACC', 'NAcc'), ('NUSERS', 'NUsers'), ('TOTCPU', 'TotCPU')]
+
+    def __init__(self, pop_db_api=None, db_path='/home/bockelman/barrefors/db/',
+                 db_file='dyndta.db', settle_days=2, refresh=6*3600):
+        """
+        __init__
+
+        Establish database connection and set up database
+
+        Keyword arguments:
+        pop_db_api  -- PopDBAPI object to reuse, a new one is created if None
+        db_path     -- Path to database file
+        db_file     -- File name of database
+        settle_days -- Days are downloaded again until they are this old
+        refresh     -- Seconds before a day which hasn't settled is downloaded again
+        """
+        self.name        = "DynDTAPopularityStore"
+        self.logger      = DynDTALogger()
+        self.pop_db_api  = pop_db_api or PopDBAPI()
+        self.settle_days = settle_days
+        self.refresh     = refresh
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+        except OSError, e:
+            # Couldn't create path to db file
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
+            sys.exit(1)
+
+        self.connection = lite.connect(db_path + db_file)
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS PopularityDay (Day TEXT, Dataset TEXT, NAcc INTEGER, NUsers INTEGER, TotCPU REAL, PRIMARY KEY (Day, Dataset))')
+                cur.execute('CREATE TABLE IF NOT EXISTS PopularitySync (Day TEXT PRIMARY KEY, Fetched REAL)')
+        except lite.Error:
+            self.logger.error(self.name, "Couldn't initialize database")
+            sys.exit(1)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  S Y N C                                 #
+    #                                                                          #
+    ############################################################################
+
+    def sync(self, days):
+        """
+        _sync_
+
+        Download the days which are not stored or haven't settled, days in the
+        future are skipped
+
+        Keyword arguments:
+        days -- List of datetime.date
+
+        Return values:
+        check -- 0 if all went well, 1 if any day couldn't be downloaded
+        data  -- Number of days downloaded
+        """
+        now = time.time()
+        today = datetime.date.today()
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Day, Fetched FROM PopularitySync')
+            fetched = dict(cur.fetchall())
+        check = 0
+        n_days = 0
+        for day in days:
+            if day > today:
+                continue
+            if str(day) in fetched:
+                settled = time.mktime((day + datetime.timedelta(days=self.settle_days)).timetuple())
+                if (fetched[str(day)] >= settled) or (now - fetched[str(day)] < self.refresh):
+                    continue
+            error, data = self.pop_db_api.getDSStatInTimeWindow(tstart=day, tstop=day)
+            if error:
+                self.logger.error(self.name, "Couldn't download %s" % (str(day),))
+                check = 1
+                continue
+            rows = [(str(day), dataset.get('COLLNAME'), dataset.get('NACC') or 0,
+                     dataset.get('NUSERS') or 0, dataset.get('TOTCPU') or 0) for dataset in data or []]
+            try:
+                with self.connection:
+                    cur = self.connection.cursor()
+                    cur.execute('DELETE FROM PopularityDay WHERE Day=?', (str(day),))
+                    cur.executemany('INSERT OR REPLACE INTO PopularityDay VALUES(?,?,?,?,?)', rows)
+                    cur.execute('INSERT OR REPLACE INTO PopularitySync VALUES(?,?)', (str(day), now))
+            except lite.Error:
+                self.logger.error(self.name, "Exception while inserting data")
+                check = 1
+                continue
+            n_days += 1
+        if n_days:
+            self.logger.log(self.name, "Downloaded %d days" % (n_days,))
+        return check, n_days
+
+
+    ############################################################################
+    #                                                                          #
+    #                                S E R I E S                               #
+    #                                                                          #
+    ############################################################################
+
+    def series(self, tstart, tstop):
+        """
+        _series_
+
+        Daily statistics of all datasets accessed from tstart to tstop, both
+        days included. Missing days are downloaded first.
+
+        Keyword arguments:
+        tstart -- First day, datetime.date
+        tstop  -- Last day, datetime.date
+
+        Return values:
+        check    -- 0 if all went well, 1 if any day couldn't be downloaded
+        datasets -- Dataset names, one row in each matrix per dataset
+        matrices -- Dictionary Popularity DB field -> datasets x days array
+        """
+        days = [tstart + datetime.timedelta(days=i) for i in range((tstop - tstart).days + 1)]
+        check, n_days = self.sync(days)
+        columns = dict((str(day), i) for i, day in enumerate(days))
+        rows = dict()
+        cells = []
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Dataset, Day, %s FROM PopularityDay WHERE Day>=? AND Day<=?' % (', '.join(column for field, column in self.METRICS),),
+                        (str(tstart), str(tstop)))
+            for row in cur:
+                cells.append((rows.setdefault(row[0], len(rows)), columns[row[1]]) + row[2:])
+        matrices = dict()
+        cells = numpy.array(cells, dtype=float).reshape(-1, 2 + len(self.METRICS))
+        index = (cells[:, 0].astype(int), cells[:, 1].astype(int))
+        for i, (field, column) in enumerate(self.METRICS):
+            matrix = numpy.zeros((len(rows), len(days)))
+            matrix[index] = cells[:, 2 + i]
+            matrices[field] = matrix
+        datasets = sorted(rows, key=rows.get)
+        return check, datasets, matrices
+
+
+    ############################################################################
+    #                                                                          #
+    #                 S T A T   I N   T I M E   W I N D O W                    #
+    #                                                                          #
+    ############################################################################
+
+    def statInTimeWindow(self, tstart, tstop):
+        """
+        _statInTimeWindow_
+
+        Same as PopDBAPI.getDSStatInTimeWindow but summed from the stored days,
+        users are summed per day so users active on several days count more
+        than once
+
+        Keyword arguments:
+        tstart -- First day, datetime.date
+        tstop  -- Last day, datetime.date
+
+        Return values:
+        check -- 0 if all went well, 1 if any day couldn't be downloaded
+        data  -- List of {COLLNAME, NACC, NUSERS, TOTCPU}, most accessed first
+        """
+        check, datasets, matrices = self.series(tstart, tstop)
+        sums = dict((field, matrix.sum(axis=1).tolist()) for field, matrix in matrices.iteritems())
+        data = []
+        for i, dataset in enumerate(datasets):
+            stat = dict((field, values[i]) for field, values in sums.iteritems())
+            stat['NACC'] = int(stat['NACC'])
+            stat['NUSERS'] = int(stat['NUSERS'])
+            stat['COLLNAME'] = dataset
+            data.append(stat)
+        data.sort(key=lambda stat: stat['NACC'], reverse=True)
+        return check, data
+
+
+    ############################################################################
+    #                                                                          #
+    #                     W E I G H T E D   P O P U L A R I T Y                #
+    #                                                                          #
+    ############################################################################
+
+    def weightedPopularity(self, tstop, days=30, half_life=7.0, field='NACC'):
+        """
+        _weightedPopularity_
+
+        Exponentially weighted sum of a daily statistic, the weight halves every
+        half_life days back from tstop
+
+        Keyword arguments:
+        tstop     -- Last day, datetime.date
+        days      -- Number of days to include
+        half_life -- Days until the weight of a day is halved
+        field     -- Popularity DB field, NACC/NUSERS/TOTCPU
+
+        Return values:
+        check      -- 0 if all went well, 1 if any day couldn't be downloaded
+        popularity -- Dictionary dataset -> weighted sum
+        """
+        tstart = tstop - datetime.timedelta(days=days - 1)
+        check, datasets, matrices = self.series(tstart, tstop)
+        age = numpy.arange(days - 1, -1, -1, dtype=float)
+        weights = 0.5 ** (age / half_life)
+        return check, dict(zip(datasets, matrices[field].dot(weights).tolist()))
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    popularity = DynDTAPopularityStore()
+    tstop = datetime.date.today()
+    check, data = popularity.statInTimeWindow(tstop - datetime.timedelta(days=1), tstop)
+    print data[:10]
+    sys.exit(0)
@@ -0,0 +1,151 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTARanking_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import numpy
+
+
+################################################################################
+#                                                                              #
+#                               F O R M U L A S                                #
+#                                                                              #
+################################################################################
+
+def popularity(n_access_t, n_access_2t, n_replicas, size_TB):
+    """
+    _popularity_
+
+    Popularity rank, increasing popularity over small and rare datasets
+
+    log10(n_t) * max(2n_t - n_2t, 1) / (size_TB * n_replicas^2)
+    """
+    return (numpy.log10(n_access_t)*numpy.maximum(2*n_access_t - n_access_2t, 1)) / (size_TB*(n_replicas**2))
+
+
+def balance(n_access_t, n_access_2t, n_replicas, size_TB):
+    """
+    _balance_
+
+    Balance metric delta_f from the project proposal, how far above the
+    average accesses per replicated GB a dataset is
+
+    delta   = n_t / (size_GB * n_replicas)
+    delta_f = delta - mean(delta)
+    """
+    delta = n_access_t / (1000*size_TB*n_replicas)
+    finite = numpy.isfinite(delta)
+    if not finite.any():
+        return delta
+    return delta - delta[finite].mean()
+
+
+################################################################################
+#                                                                              #
+#                          D Y N D T A   R A N K I N G                         #
+#                                                                              #
+################################################################################
+
+class DynDTARanking:
+    """
+    _DynDTARanking_
+
+    Score all candidate datasets at once.
+
+    Accesses, sizes and replica counts are loaded into aligned arrays and the
+    scoring formula, threshold and sort order are computed on whole arrays.
+    Formulas take the arrays n_access_t, n_access_2t, n_replicas and size_TB
+    and return an array of ranks.
+
+    Class variables:
+    FORMULAS  -- Name -> (formula, default threshold)
+    formula   -- Formula used to rank
+    threshold -- Datasets ranked below this are dropped
+    """
+    FORMULAS = { 'popularity' : (popularity, 200),
+                 'balance'    : (balance, 0) }
+
+    def __init__(self, formula='popularity', threshold=None):
+        """
+        __init__
+
+        Set up class constants
+
+        Keyword arguments:
+        formula   -- Name of formula in FORMULAS or a function
+        threshold -- Drop datasets ranked below this, default depends on formula
+        """
+        if callable(formula):
+            self.formula = formula
+            self.threshold = threshold
+        else:
+            self.formula, default = self.FORMULAS[formula]
+            if threshold is None:
+                threshold = default
+            self.threshold = threshold
+
+
+    ############################################################################
+    #                                                                          #
+    #                                 R A N K                                  #
+    #                                                                          #
+    ############################################################################
+
+    def rank(self, datasets, n_access_t, n_access_2t, n_replicas, size_TB):
+        """
+        _rank_
+
+        Rank datasets, all arguments are aligned sequences
+
+        Datasets whose rank can't be computed, ex zero accesses or size, get
+        rank 0.
+
+        Keyword arguments:
+        datasets    -- Dataset names
+        n_access_t  -- Accesses in the last time window
+        n_access_2t -- Accesses in the last two time windows
+        n_replicas  -- Number of replicas
+        size_TB     -- Size in TB
+
+        Return values:
+        ranking -- List of (dataset, rank) above threshold, highest rank first
+        """
+        if not len(datasets):
+            return []
+        datasets = numpy.asarray(datasets, dtype=object)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ranks = self.formula(numpy.asarray(n_access_t, dtype=float),
+                                 numpy.asarray(n_access_2t, dtype=float),
+                                 numpy.asarray(n_replicas, dtype=float),
+                                 numpy.asarray(size_TB, dtype=float))
+        ranks[~numpy.isfinite(ranks)] = 0
+        if self.threshold is not None:
+            keep = ranks >= self.threshold
+            datasets = datasets[keep]
+            ranks = ranks[keep]
+        order = numpy.argsort(-ranks, kind='mergesort')
+        return zip(datasets[order].tolist(), ranks[order].tolist())
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    ranking = DynDTARanking()
+    print ranking.rank(['/A/B/AOD', '/C/D/AOD'], [10000, 100], [12000, 150], [1, 5], [0.5, 2])
+    sys.exit(0)
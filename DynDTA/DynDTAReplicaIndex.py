@@ -0,0 +1,255 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAReplicaIndex_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+
+from DynDTALogger        import DynDTALogger
+from DynDTAReplicaMirror import DynDTAReplicaMirror
+
+
+################################################################################
+#                                                                              #
+#                    D Y N D T A   R E P L I C A   I N D E X                   #
+#                                                                              #
+################################################################################
+
+class DynDTAReplicaIndex:
+    """
+    _DynDTAReplicaIndex_
+
+    In memory index of where datasets have replicas.
+
+    The index is loaded from the local replica mirror after it is synced and
+    answers all replica questions asked during a run without any further
+    PhEDEx calls.
+
+    The mirror only has replicas owned by the group, which decides what data
+    is ours. A site holding a dataset under another group still has it, so the
+    sites of every indexed dataset are also looked up for all groups in batched
+    calls. Replica counts and site checks use these, see nReplicas and
+    hasReplica.
+
+    Class variables:
+    name           -- ID used when logging
+    logger         -- Used to print log and error messages to log file
+    phedex_api     -- Used to look up replicas of all groups
+    replica_mirror -- Local copy of block replicas the index is loaded from
+    blocks         -- Number of blocks in each dataset
+    replicas       -- dataset -> {site : [complete blocks, bytes]} of the group
+    all_sites      -- dataset -> sites with any block of it, of any group
+    failed         -- Datasets whose replicas of all groups couldn't be looked up
+    """
+    def __init__(self, phedex_api=None, replica_mirror=None):
+        """
+        __init__
+
+        Set up class constants
+
+        Keyword arguments:
+        phedex_api     -- PhEDExAPI object to reuse, a new one is created if None
+        replica_mirror -- DynDTAReplicaMirror to reuse, a new one is created if None
+        """
+        self.name           = "DynDTAReplicaIndex"
+        self.logger         = DynDTALogger()
+        self.replica_mirror = replica_mirror or DynDTAReplicaMirror(phedex_api)
+        self.phedex_api     = self.replica_mirror.phedex_api
+        self.clear()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                C L E A R                                 #
+    #                                                                          #
+    ############################################################################
+
+    def clear(self):
+        """
+        _clear_
+
+        Drop everything currently in the index
+        """
+        self.blocks    = dict()
+        self.replicas  = dict()
+        self.all_sites = dict()
+        self.failed    = set()
+
+
+    ############################################################################
+    #                                                                          #
+    #                                B U I L D                                 #
+    #                                                                          #
+    ############################################################################
+
+    def build(self, group='AnalysisOps'):
+        """
+        _build_
+
+        Sync the replica mirror and rebuild the index from it for all data
+        owned by group, then look up the replicas of all groups of that data
+
+        Keyword arguments:
+        group -- Group whose replicas should be indexed
+
+        Return values:
+        check -- 0 if all went well, 1 if error occured
+        data  -- Number of datasets in index or error message
+        """
+        check, n_replicas = self.replica_mirror.sync(group)
+        if check:
+            self.logger.error(self.name, "Couldn't sync block replicas")
+            return 1, "Error"
+        self.clear()
+        self.blocks, replicas = self.replica_mirror.replicas(group)
+        for dataset, site, complete, bytes in replicas:
+            self.replicas.setdefault(dataset, dict())[site] = [complete, bytes]
+        self.allGroups(self.replicas.keys())
+        self.logger.log(self.name, "Indexed %d datasets" % (len(self.replicas),))
+        return 0, len(self.replicas)
+
+
+    ############################################################################
+    #                                                                          #
+    #                           A L L   G R O U P S                            #
+    #                                                                          #
+    ############################################################################
+
+    def allGroups(self, datasets):
+        """
+        _allGroups_
+
+        Look up the sites with any block of datasets, whoever owns the replica
+
+        Datasets which couldn't be looked up are kept in failed.
+
+        Keyword arguments:
+        datasets -- Datasets to look up
+        """
+        results = self.phedex_api.blockReplicasBatch(key='dataset', values=datasets)
+        for dataset, (check, response) in results.iteritems():
+            if check:
+                self.failed.add(dataset)
+                continue
+            sites = set()
+            for block in response.get('phedex').get('block'):
+                for replica in block.get('replica') or []:
+                    sites.add(replica.get('node'))
+            self.all_sites[dataset] = sites
+        if self.failed:
+            self.logger.error(self.name, "Couldn't look up replicas of all groups for %d datasets" % (len(self.failed),))
+
+
+    ############################################################################
+    #                                                                          #
+    #                             C O N T A I N S                              #
+    #                                                                          #
+    ############################################################################
+
+    def contains(self, dataset):
+        """
+        _contains_
+
+        Check if dataset have any replica in the index
+        """
+        return bool(self.replicas.get(dataset))
+
+
+    ############################################################################
+    #                                                                          #
+    #                             D A T A S E T S                              #
+    #                                                                          #
+    ############################################################################
+
+    def datasets(self):
+        """
+        _datasets_
+
+        Get all datasets in the index
+        """
+        return self.replicas.keys()
+
+
+    ############################################################################
+    #                                                                          #
+    #                            N   R E P L I C A S                           #
+    #                                                                          #
+    ############################################################################
+
+    def nReplicas(self, dataset):
+        """
+        _nReplicas_
+
+        Number of sites with a complete or partial replica of dataset, of any
+        group. 0 if it couldn't be looked up.
+        """
+        return len(self.all_sites.get(dataset, ()))
+
+
+    ############################################################################
+    #                                                                          #
+    #                          H A S   R E P L I C A                           #
+    #                                                                          #
+    ############################################################################
+
+    def hasReplica(self, dataset, site):
+        """
+        _hasReplica_
+
+        Check if site have a complete or partial replica of dataset, of any
+        group. Datasets which couldn't be looked up are assumed to be there.
+        """
+        if dataset in self.failed:
+            return True
+        return site in self.all_sites.get(dataset, ())
+
+
+    ############################################################################
+    #                                                                          #
+    #                                S I T E S                                 #
+    #                                                                          #
+    ############################################################################
+
+    def sites(self, dataset):
+        """
+        _sites_
+
+        Get all replicas of dataset
+
+        Return values:
+        sites -- site -> (complete/partial, bytes)
+        """
+        sites = dict()
+        n_blocks = self.blocks.get(dataset, 0)
+        for site, (complete, bytes) in self.replicas.get(dataset, dict()).iteritems():
+            if complete == n_blocks:
+                sites[site] = ('complete', bytes)
+            else:
+                sites[site] = ('partial', bytes)
+        return sites
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    replica_index = DynDTAReplicaIndex()
+    check, n_datasets = replica_index.build()
+    if check:
+        sys.exit(1)
+    print n_datasets
+    sys.exit(0)
@@ -0,0 +1,311 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTAReplicaMirror_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import time
+import socket
+import httplib
+import sqlite3 as lite
+
+from DynDTALogger import DynDTALogger
+from PhEDExAPI    import PhEDExAPI
+
+
+################################################################################
+#                                                                              #
+#                   D Y N D T A   R E P L I C A   M I R R O R                  #
+#                                                                              #
+################################################################################
+
+class DynDTAReplicaMirror:
+    """
+    _DynDTAReplicaMirror_
+
+    Local copy of all block replicas owned by a group.
+
+    The first sync downloads every block replica of the group, later syncs
+    only download replicas updated or created since the last sync and remove
+    replicas whose deletion completed since then. A full download is done
+    again once the mirror is older than max_age, this catches replicas moved
+    to another group which the deltas don't show.
+
+    Class variables:
+    name       -- ID used when logging
+    logger     -- Used to print log and error messages to log file
+    phedex_api -- Used to download block replicas and deletions
+    connection -- Established connection to the database
+    max_age    -- Seconds between full downloads
+    overlap    -- Seconds each delta overlaps the previous sync
+    FIELDS     -- Fields of each block kept when streaming block replicas
+    """
+    FIELDS = { 'name' : None, 'bytes' : None, 'files' : None, 'is_open' : None,
+               'replica' : { 'node' : None, 'bytes' : None, 'complete' : None,
+                             'subscribed' : None, 'custodial' : None,
+                             'group' : None, 'time_update' : None } }
+
+    def __init__(self, phedex_api=None, db_path='/home/bockelman/barrefors/db/',
+                 db_file='dyndta.db', days=7):
+        """
+        __init__
+
+        Establish database connection and set up database
+
+        Keyword arguments:
+        phedex_api -- PhEDExAPI object to reuse, a new one is created if None
+        db_path    -- Path to database file
+        db_file    -- File name of database
+        days       -- Days between full downloads
+        """
+        self.name       = "DynDTAReplicaMirror"
+        self.logger     = DynDTALogger()
+        self.phedex_api = phedex_api or PhEDExAPI()
+        self.max_age    = days*86400
+        self.overlap    = 600
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+        except OSError, e:
+            # Couldn't create path to db file
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
+            sys.exit(1)
+
+        self.connection = lite.connect(db_path + db_file)
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS Block (BlockName TEXT PRIMARY KEY, Dataset TEXT, Bytes INTEGER, Files INTEGER, IsOpen TEXT)')
+                cur.execute('CREATE INDEX IF NOT EXISTS BlockDataset ON Block (Dataset)')
+                cur.execute('CREATE TABLE IF NOT EXISTS BlockReplica (BlockName TEXT, Site TEXT, GroupName TEXT, Bytes INTEGER, Complete TEXT, Subscribed TEXT, Custodial TEXT, TimeUpdate REAL, PRIMARY KEY (BlockName, Site))')
+                cur.execute('CREATE INDEX IF NOT EXISTS BlockReplicaSite ON BlockReplica (Site, GroupName)')
+                cur.execute('CREATE TABLE IF NOT EXISTS MirrorSync (GroupName TEXT PRIMARY KEY, Synced REAL, FullSync REAL)')
+        except lite.Error:
+            self.logger.error(self.name, "Couldn't initialize database")
+            sys.exit(1)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  S Y N C                                 #
+    #                                                                          #
+    ############################################################################
+
+    def sync(self, group='AnalysisOps'):
+        """
+        _sync_
+
+        Bring the mirror up to date, see class description
+
+        Everything is done in one transaction, if anything fails the mirror is
+        left as it was.
+
+        Keyword arguments:
+        group -- Group whose replicas are mirrored
+
+        Return values:
+        check -- 0 if all went well, 1 if error occured
+        data  -- Number of block replicas downloaded or error message
+        """
+        now = time.time()
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Synced, FullSync FROM MirrorSync WHERE GroupName=?', (group,))
+            row = cur.fetchone()
+        full = (not row) or (now - row[1] > self.max_age)
+        n_replicas = 0
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                if full:
+                    cur.execute('DELETE FROM BlockReplica WHERE GroupName=?', (group,))
+                    full_sync = now
+                    n_replicas += self.download(cur, group=group)
+                else:
+                    since = int(row[0] - self.overlap)
+                    full_sync = row[1]
+                    n_replicas += self.download(cur, group=group, update_since=since)
+                    n_replicas += self.download(cur, group=group, create_since=since)
+                    self.removeDeleted(cur, since)
+                cur.execute('DELETE FROM Block WHERE BlockName NOT IN (SELECT BlockName FROM BlockReplica)')
+                cur.execute('INSERT OR REPLACE INTO MirrorSync VALUES(?,?,?)', (group, now, full_sync))
+        except (ValueError, socket.error, httplib.HTTPException, lite.Error), e:
+            self.logger.error(self.name, "Couldn't sync replicas. Reason: %s" % (str(e),))
+            return 1, "Error"
+        if full:
+            self.logger.log(self.name, "Full sync of %s, %d block replicas" % (group, n_replicas))
+        else:
+            self.logger.log(self.name, "Delta sync of %s, %d block replicas" % (group, n_replicas))
+        return 0, n_replicas
+
+
+    ############################################################################
+    #                                                                          #
+    #                              D O W N L O A D                             #
+    #                                                                          #
+    ############################################################################
+
+    def download(self, cur, **kwargs):
+        """
+        _download_
+
+        Stream block replicas from PhEDEx into the mirror
+
+        Raises ValueError if the call fails or the response is malformed.
+
+        Keyword arguments:
+        cur    -- Cursor of open transaction
+        kwargs -- Arguments to blockReplicasStream
+
+        Return values:
+        n_replicas -- Number of block replicas downloaded
+        """
+        check, blocks = self.phedex_api.blockReplicasStream(fields=self.FIELDS, **kwargs)
+        if check:
+            raise ValueError("blockReplicas call failed")
+        n_replicas = 0
+        block_rows = []
+        replica_rows = []
+        for block in blocks:
+            block_name = block.get('name')
+            block_rows.append((block_name, block_name.split('#')[0], block.get('bytes'),
+                               block.get('files'), block.get('is_open')))
+            for replica in block.get('replica') or []:
+                replica_rows.append((block_name, replica.get('node'), replica.get('group'),
+                                     replica.get('bytes'), replica.get('complete'),
+                                     replica.get('subscribed'), replica.get('custodial'),
+                                     float(replica.get('time_update') or 0)))
+            if len(replica_rows) >= 10000:
+                n_replicas += self.insert(cur, block_rows, replica_rows)
+                block_rows = []
+                replica_rows = []
+        n_replicas += self.insert(cur, block_rows, replica_rows)
+        return n_replicas
+
+
+    ############################################################################
+    #                                                                          #
+    #                                I N S E R T                               #
+    #                                                                          #
+    ############################################################################
+
+    def insert(self, cur, block_rows, replica_rows):
+        """
+        _insert_
+
+        Insert or replace blocks and block replicas
+
+        Return values:
+        n_replicas -- Number of block replicas inserted
+        """
+        cur.executemany('INSERT OR REPLACE INTO Block VALUES(?,?,?,?,?)', block_rows)
+        cur.executemany('INSERT OR REPLACE INTO BlockReplica VALUES(?,?,?,?,?,?,?,?)', replica_rows)
+        return len(replica_rows)
+
+
+    ############################################################################
+    #                                                                          #
+    #                         R E M O V E   D E L E T E D                      #
+    #                                                                          #
+    ############################################################################
+
+    def removeDeleted(self, cur, since):
+        """
+        _removeDeleted_
+
+        Remove replicas whose deletion completed since the given time
+
+        A replica updated after the deletion completed was made again and is
+        kept. Raises ValueError if the call fails.
+
+        Keyword arguments:
+        cur   -- Cursor of open transaction
+        since -- Unix time of last sync
+        """
+        check, response = self.phedex_api.deletions(complete='y', complete_since=since)
+        if check:
+            raise ValueError("deletions call failed")
+        block_rows = []
+        dataset_rows = []
+        for dataset in response.get('phedex').get('dataset') or []:
+            for deletion in dataset.get('deletion') or []:
+                dataset_rows.append((deletion.get('node'), float(deletion.get('time_complete') or 0), dataset.get('name')))
+            for block in dataset.get('block') or []:
+                for deletion in block.get('deletion') or []:
+                    block_rows.append((block.get('name'), deletion.get('node'), float(deletion.get('time_complete') or 0)))
+        cur.executemany('DELETE FROM BlockReplica WHERE BlockName=? AND Site=? AND TimeUpdate<=?', block_rows)
+        cur.executemany('DELETE FROM BlockReplica WHERE Site=? AND TimeUpdate<=? AND BlockName IN (SELECT BlockName FROM Block WHERE Dataset=?)', dataset_rows)
+
+
+    ############################################################################
+    #                                                                          #
+    #                            U S E D   S P A C E                           #
+    #                                                                          #
+    ############################################################################
+
+    def usedSpace(self, group='AnalysisOps'):
+        """
+        _usedSpace_
+
+        Space used by group at each site in TB
+
+        A subscribed replica counts as the full block, otherwise the bytes
+        already at the site are counted.
+
+        Return values:
+        used -- Dictionary site -> TB, sites without replicas are left out
+        """
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute("SELECT Site, SUM(CASE WHEN Subscribed='y' THEN Block.Bytes ELSE BlockReplica.Bytes END) FROM BlockReplica JOIN Block USING (BlockName) WHERE GroupName=? GROUP BY Site", (group,))
+            return dict((site, float(bytes or 0) / 10**12) for site, bytes in cur)
+
+
+    ############################################################################
+    #                                                                          #
+    #                              R E P L I C A S                             #
+    #                                                                          #
+    ############################################################################
+
+    def replicas(self, group='AnalysisOps'):
+        """
+        _replicas_
+
+        Replicas of all datasets with blocks owned by group
+
+        Return values:
+        blocks   -- Dictionary dataset -> number of blocks owned by group
+        replicas -- List of (dataset, site, complete blocks, bytes)
+        """
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Dataset, COUNT(DISTINCT BlockName) FROM BlockReplica JOIN Block USING (BlockName) WHERE GroupName=? GROUP BY Dataset', (group,))
+            blocks = dict(cur.fetchall())
+            cur.execute("SELECT Dataset, Site, SUM(Complete='y'), SUM(BlockReplica.Bytes) FROM BlockReplica JOIN Block USING (BlockName) WHERE GroupName=? GROUP BY Dataset, Site", (group,))
+            replicas = cur.fetchall()
+        return blocks, replicas
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    replica_mirror = DynDTAReplicaMirror()
+    print replica_mirror.sync()
+    print replica_mirror.usedSpace()
+    sys.exit(0)
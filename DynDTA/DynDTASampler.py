@@ -0,0 +1,227 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTASampler_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import random
+
+
+################################################################################
+#                                                                              #
+#                          D Y N D T A   S A M P L E R                         #
+#                                                                              #
+################################################################################
+
+class DynDTASampler:
+    """
+    _DynDTASampler_
+
+    Weighted random sampling without replacement.
+
+    Weights are kept in a Fenwick (binary indexed) tree so sampling, removing
+    and changing the weight of a key are all O(log n). Negative weights are
+    treated as 0, keys with weight 0 are never sampled.
+
+    Class variables:
+    rng     -- Random number generator, seed it for reproducible runs
+    keys    -- Slot -> key
+    slots   -- Key -> slot
+    weights -- Slot -> weight
+    tree    -- Fenwick tree of weights, 1-indexed
+    """
+    def __init__(self, weights=dict(), rng=None):
+        """
+        __init__
+
+        Build the tree in O(n)
+
+        Keyword arguments:
+        weights -- Dictionary key -> weight
+        rng     -- random.Random object to draw from, a new one if None
+        """
+        self.rng = rng or random.Random()
+        self.build(weights.iteritems(), len(weights))
+
+
+    ############################################################################
+    #                                                                          #
+    #                                B U I L D                                 #
+    #                                                                          #
+    ############################################################################
+
+    def build(self, items, capacity):
+        """
+        _build_
+
+        Rebuild the tree from (key, weight) pairs with room for capacity keys
+        """
+        self.keys = []
+        self.slots = dict()
+        self.weights = []
+        for key, weight in items:
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.weights.append(max(weight, 0))
+        capacity = max(capacity, len(self.keys), 1)
+        self.tree = [0]*(capacity + 1)
+        for i, weight in enumerate(self.weights):
+            self.tree[i + 1] += weight
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+
+    ############################################################################
+    #                                                                          #
+    #                               U P D A T E                                #
+    #                                                                          #
+    ############################################################################
+
+    def update(self, key, weight):
+        """
+        _update_
+
+        Set the weight of key, the key is added if not already in the sampler
+        """
+        weight = max(weight, 0)
+        if key not in self.slots:
+            if len(self.keys) + 1 >= len(self.tree):
+                items = [(k, self.weights[s]) for k, s in self.slots.iteritems()]
+                self.build(items, 2*len(self.tree))
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.weights.append(0)
+        slot = self.slots[key]
+        delta = weight - self.weights[slot]
+        self.weights[slot] = weight
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+
+    ############################################################################
+    #                                                                          #
+    #                               R E M O V E                                #
+    #                                                                          #
+    ############################################################################
+
+    def remove(self, key):
+        """
+        _remove_
+
+        Remove key from the sampler
+        """
+        self.update(key, 0)
+        del self.slots[key]
+
+
+    ############################################################################
+    #                                                                          #
+    #                                T O T A L                                 #
+    #                                                                          #
+    ############################################################################
+
+    def total(self):
+        """
+        _total_
+
+        Sum of all weights
+        """
+        total = 0
+        i = len(self.keys)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+    ############################################################################
+    #                                                                          #
+    #                               S A M P L E                                #
+    #                                                                          #
+    ############################################################################
+
+    def sample(self):
+        """
+        _sample_
+
+        Return a weighted randomly selected key, None if all weights are 0
+        """
+        total = self.total()
+        if total <= 0:
+            return None
+        r = self.rng.uniform(0, total)
+        # Find the first slot where the prefix sum reaches r
+        slot = 0
+        step = 1
+        while 2*step < len(self.tree):
+            step *= 2
+        while step:
+            if (slot + step < len(self.tree)) and (self.tree[slot + step] < r):
+                slot += step
+                r -= self.tree[slot]
+            step /= 2
+        # Floating point rounding can land on a slot without weight
+        slot = min(slot, len(self.keys) - 1)
+        while (slot > 0) and (self.weights[slot] <= 0):
+            slot -= 1
+        while (slot < len(self.keys)) and (self.weights[slot] <= 0):
+            slot += 1
+        if slot == len(self.keys):
+            return None
+        return self.keys[slot]
+
+
+    ############################################################################
+    #                                                                          #
+    #                                  P O P                                   #
+    #                                                                          #
+    ############################################################################
+
+    def pop(self):
+        """
+        _pop_
+
+        Return a weighted randomly selected key and remove it from the sampler
+        """
+        key = self.sample()
+        if key is not None:
+            self.remove(key)
+        return key
+
+
+    def __len__(self):
+        return len(self.slots)
+
+
+    def __contains__(self, key):
+        return key in self.slots
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    sampler = DynDTASampler({'a' : 1, 'b' : 2, 'c' : 7}, random.Random(0))
+    counts = {'a' : 0, 'b' : 0, 'c' : 0}
+    for i in xrange(10000):
+        counts[sampler.sample()] += 1
+    print counts
+    sys.exit(0)
@@ -0,0 +1,198 @@
+#!/usr/bin/python -B
+
+"""
+_DynDTASizeCatalog_
+
+Part of DynDTA (Dynamic Data Transfer Agent)
+
+Holland Computing Center - University of Nebraska-Lincoln
+"""
+__organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
+
+import sys
+import os
+import datetime
+import sqlite3 as lite
+
+from DynDTALogger import DynDTALogger
+from PhEDExAPI    import PhEDExAPI
+
+
+################################################################################
+#                                                                              #
+#                   D Y N D T A   S I Z E   C A T A L O G                      #
+#                                                                              #
+################################################################################
+
+class DynDTASizeCatalog:
+    """
+    _DynDTASizeCatalog_
+
+    Persistent catalog of dataset sizes.
+
+    Keeps size, number of blocks and open state of each dataset. Closed datasets
+    almost never change size so they are only looked up again once their entry
+    is older than max_age, open datasets are looked up on every refresh.
+
+    Class variables:
+    name       -- ID used when logging
+    logger     -- Used to print log and error messages to log file
+    phedex_api -- Used to look up dataset sizes
+    connection -- Established connection to the database
+    max_age    -- Closed entries older than this are looked up again
+    catalog    -- In memory copy of the catalog, dataset -> (bytes, blocks, is_open, updated)
+    """
+    def __init__(self, phedex_api=None, db_path='/home/bockelman/barrefors/db/',
+                 db_file='dyndta.db', max_age=datetime.timedelta(days=7)):
+        """
+        __init__
+
+        Establish database connection and load catalog
+
+        Keyword arguments:
+        phedex_api -- PhEDExAPI object to reuse, a new one is created if None
+        db_path    -- Path to database file
+        db_file    -- File name of database
+        max_age    -- Closed entries older than this are looked up again
+        """
+        self.name       = "DynDTASizeCatalog"
+        self.logger     = DynDTALogger()
+        self.phedex_api = phedex_api or PhEDExAPI()
+        self.max_age    = max_age
+        try:
+            if not os.path.isdir(db_path):
+                os.makedirs(db_path)
+        except OSError, e:
+            # Couldn't create path to db file
+            self.logger.error(self.name, "Couldn\'t access db file. Reason: %s" % (e,))
+            sys.exit(1)
+
+        self.connection = lite.connect(db_path + db_file, detect_types=lite.PARSE_DECLTYPES)
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.execute('CREATE TABLE IF NOT EXISTS DatasetSize (Dataset TEXT PRIMARY KEY, Bytes INTEGER, Blocks INTEGER, IsOpen TEXT, Updated TIMESTAMP)')
+        except lite.Error:
+            self.logger.error(self.name, "Couldn't initialize database")
+            sys.exit(1)
+        self.catalog = dict()
+        with self.connection:
+            cur = self.connection.cursor()
+            cur.execute('SELECT Dataset, Bytes, Blocks, IsOpen, Updated FROM DatasetSize')
+            for row in cur:
+                self.catalog[row[0]] = row[1:]
+
+
+    ############################################################################
+    #                                                                          #
+    #                                S T A L E                                 #
+    #                                                                          #
+    ############################################################################
+
+    def stale(self, dataset):
+        """
+        _stale_
+
+        Check if dataset need to be looked up again
+        """
+        try:
+            bytes, blocks, is_open, updated = self.catalog[dataset]
+        except KeyError:
+            return True
+        if is_open != 'n':
+            return True
+        return (datetime.datetime.now() - updated) > self.max_age
+
+
+    ############################################################################
+    #                                                                          #
+    #                              R E F R E S H                               #
+    #                                                                          #
+    ############################################################################
+
+    def refresh(self, datasets):
+        """
+        _refresh_
+
+        Look up all missing, open or too old datasets, many per call, and store
+        them in the catalog in one transaction
+
+        Keyword arguments:
+        datasets -- Names of datasets which will be needed
+
+        Return values:
+        check -- 0 if all went well, 1 if any dataset couldn't be looked up
+        data  -- Number of datasets looked up
+        """
+        stale = [dataset for dataset in set(datasets) if self.stale(dataset)]
+        if not stale:
+            return 0, 0
+        responses = self.phedex_api.dataBatch(key='dataset', values=stale)
+        now = datetime.datetime.now()
+        rows = []
+        check = 0
+        for dataset, (error, response) in responses.iteritems():
+            if error:
+                check = 1
+                continue
+            try:
+                data = response.get('phedex').get('dbs')[0].get('dataset')[0]
+            except (IndexError, AttributeError, TypeError):
+                check = 1
+                continue
+            blocks = data.get('block') or []
+            bytes = sum(block.get('bytes') for block in blocks)
+            row = (bytes, len(blocks), data.get('is_open'), now)
+            self.catalog[dataset] = row
+            rows.append((dataset,) + row)
+        try:
+            with self.connection:
+                cur = self.connection.cursor()
+                cur.executemany('INSERT OR REPLACE INTO DatasetSize VALUES(?,?,?,?,?)', rows)
+        except lite.Error:
+            self.logger.error(self.name, "Exception while inserting data")
+            return 1, len(rows)
+        self.logger.log(self.name, "Refreshed %d of %d datasets" % (len(rows), len(stale)))
+        return check, len(rows)
+
+
+    ############################################################################
+    #                                                                          #
+    #                                 S I Z E                                  #
+    #                                                                          #
+    ############################################################################
+
+    def size(self, dataset):
+        """
+        _size_
+
+        Get size of dataset in TB, looked up if not in catalog
+
+        Return values:
+        check -- 0 if all went well, 1 if size is not known
+        data  -- Size in TB
+        """
+        if dataset not in self.catalog:
+            self.refresh([dataset])
+        try:
+            bytes = self.catalog[dataset][0]
+        except KeyError:
+            return 1, "Unknown dataset"
+        return 0, float(bytes) / 10**12
+
+
+################################################################################
+#                                                                              #
+#                                  M A I N                                     #
+#                                                                              #
+################################################################################
+
+if __name__ == '__main__':
+    """
+    __main__
+
+    For testing purpose only
+    """
+    size_catalog = DynDTASizeCatalog()
+    print size_catalog.size("/MET/Run2012A-22Jan2013-v1/AOD")
+    sys.exit(0)
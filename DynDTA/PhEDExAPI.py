@@ -13,11 +13,10 @@ __organization__ = 'Holland Computing Center - University of Nebraska-Lincoln'
 __email__        = 'bbarrefo@cse.unl.edu'
 
 import sys
-import os
 import re
 import urllib
-import urllib2
 import httplib
+import socket
 import time
 import datetime
 try:
@@ -25,7 +24,13 @@ try:
 except ImportError:
     import simplejson as json
 
-from DynDTALogger import DynDTALogger
+from cStringIO            import StringIO
+from multiprocessing.pool import ThreadPool
+
+from DynDTALogger         import DynDTALogger
+from DynDTACache          import DynDTACache
+from DynDTAConnectionPool import DynDTAConnectionPool
+from DynDTAJSONStream     import iterJSONArray
 
 
 ################################################################################
@@ -43,7 +48,12 @@ class PhEDExAPI:
 
     Class variables:
     PHEDEX_BASE -- Base URL to the PhEDEx web API
+    THREADS     -- Default number of concurrent calls for the *Many calls
+    BATCH_NAMES -- Maximum number of names in one call for the *Batch calls
+    BATCH_BYTES -- Maximum encoded size of the names in one *Batch call
     logger      -- Used to print log and error messages to log file
+    pool        -- Keep-alive connections authenticated with the grid proxy
+    cache       -- On disk cache of responses from read only calls
     """
     # Useful variables
     # PHEDEX_BASE = "https://cmsweb.cern.ch/phedex/datasvc/"
@@ -64,6 +74,11 @@ class PhEDExAPI:
         """
         self.logger      = DynDTALogger()
         self.PHEDEX_BASE = "https://cmsweb.cern.ch/phedex/datasvc/"
+        self.THREADS     = 8
+        self.BATCH_NAMES = 100
+        self.BATCH_BYTES = 6000
+        self.pool        = DynDTAConnectionPool(proxy=True)
+        self.cache       = DynDTACache()
 
 
     ############################################################################
@@ -72,7 +87,7 @@ class PhEDExAPI:
     #                                                                          #
     ############################################################################
 
-    def phedexCall(self, url, values):
+    def phedexCall(self, url, values, stream=False):
         """
         _phedexCall_
 
@@ -81,31 +96,153 @@ class PhEDExAPI:
         Function only gaurantees that something is returned,
         the caller need to check the response for correctness.
 
+        Connections are reused between calls, the response is read in full
+        so the connection can go back to the pool. A streamed response is
+        returned unread and the connection goes back to the pool once the
+        caller have read it to the end.
+
+        Arguments with a list or tuple value are passed once for each item.
+
         Keyword arguments:
         url    -- URL to make API call
         values -- Arguments to pass to the call
+        stream -- Return the response before reading it
 
         Return values:
         1 -- Status, 0 = everything went well, 1 = something went wrong
         2 -- IF status == 0 : HTTP response ELSE : Error message
         """
         name = "phedexCall"
-        data = urllib.urlencode(values)
-        opener = urllib2.build_opener(HTTPSGridAuthHandler())
-        request = urllib2.Request(url, data)
+        data = urllib.urlencode(values, True)
+        headers = { 'Content-Type' : 'application/x-www-form-urlencoded' }
         try:
-            response = opener.open(request)
-        except urllib2.HTTPError, e:
-            self.logger.error(name, e.read())
+            response, body = self.pool.request('POST', url, data, headers, stream)
+            if stream and (response.status >= 300):
+                body = body.read()
+        except (httplib.HTTPException, socket.error), e:
+            self.logger.error(name, e.args)
             self.logger.error(name, "URL: %s" % (str(url),))
             self.logger.error(name, "VALUES: %s" % (str(values),))
             return 1, "Error"
-        except urllib2.URLError, e:
-            self.logger.error(name, e.args)
+        if response.status >= 300:
+            self.logger.error(name, body)
             self.logger.error(name, "URL: %s" % (str(url),))
             self.logger.error(name, "VALUES: %s" % (str(values),))
             return 1, "Error"
-        return 0, response
+        if stream:
+            return 0, body
+        return 0, StringIO(body)
+
+
+    ############################################################################
+    #                                                                          #
+    #                              C A L L   M A N Y                           #
+    #                                                                          #
+    ############################################################################
+
+    def callMany(self, call, key, values, threads=0, **kwargs):
+        """
+        _callMany_
+
+        Make the same API call once for each value in values, running at most
+        threads calls concurrently. Total time is bounded by the slowest calls
+        instead of the sum of all calls.
+
+        A failing call does not affect the others, its error is recorded in the
+        result for that value.
+
+        Keyword arguments:
+        call    -- API function to call, ex self.blockReplicas
+        key     -- Name of the argument each value is passed as, ex 'dataset'
+        values  -- Values to make calls for, one call per unique value
+        threads -- Maximum number of concurrent calls, default is THREADS
+        kwargs  -- Arguments passed unchanged to every call
+
+        Return values:
+        results -- Dictionary value -> (check, data) as returned by call
+        """
+        name = "callMany"
+        values = list(set(values))
+        if not values:
+            return dict()
+        threads = min(threads or self.THREADS, len(values))
+
+        def single(value):
+            args = dict(kwargs)
+            args[key] = value
+            try:
+                return value, call(**args)
+            except Exception, e:
+                self.logger.error(name, "%s=%s : %s" % (key, value, str(e)))
+                return value, (1, "Error")
+
+        pool = ThreadPool(processes=threads)
+        try:
+            results = pool.map(single, values)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(results)
+
+
+    ############################################################################
+    #                                                                          #
+    #                             C A L L   B A T C H                          #
+    #                                                                          #
+    ############################################################################
+
+    def callBatch(self, call, key, values, split, threads=0, **kwargs):
+        """
+        _callBatch_
+
+        Look up many names with few calls, PhEDEx accepts an argument several
+        times and returns the union of the results.
+
+        Names are split in chunks of at most BATCH_NAMES names and BATCH_BYTES
+        encoded bytes, the chunks are called concurrently with callMany. Each
+        response is split back into one response per name, shaped as if the
+        name had been looked up on its own. Names not found get a response
+        without data, all names in a failed chunk get the error.
+
+        Keyword arguments:
+        call    -- API function to call, ex self.data
+        key     -- Name of the argument the names are passed as, ex 'dataset'
+        values  -- Names to look up
+        split   -- Function (response, names) -> dictionary name -> response
+        threads -- Maximum number of concurrent calls, default is THREADS
+        kwargs  -- Arguments passed unchanged to every call
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        name = "callBatch"
+        chunks = []
+        chunk = []
+        size = 0
+        for value in sorted(set(values)):
+            value_size = len(key) + len(urllib.quote_plus(value)) + 2
+            if chunk and ((len(chunk) >= self.BATCH_NAMES) or (size + value_size > self.BATCH_BYTES)):
+                chunks.append(tuple(chunk))
+                chunk = []
+                size = 0
+            chunk.append(value)
+            size += value_size
+        if chunk:
+            chunks.append(tuple(chunk))
+        responses = self.callMany(call, key, chunks, threads, **kwargs)
+        results = dict()
+        for chunk, (check, data) in responses.iteritems():
+            if not check:
+                try:
+                    for value, response in split(data, chunk).iteritems():
+                        results[value] = (0, response)
+                    continue
+                except (AttributeError, TypeError, KeyError), e:
+                    self.logger.error(name, "Unexpected response structure: %s" % (str(e),))
+                    data = "Error"
+            for value in chunk:
+                results[value] = (1, data)
+        return results
 
 
     ############################################################################
@@ -128,6 +265,10 @@ class PhEDExAPI:
         Even if JSON data is returned no gaurantees are made for the structure
         of it
 
+        Responses where nothing was found are not cached, the data might be
+        registered soon. File lookups are never cached, the listener keeps
+        its own cache of them with shorter expiration for files not found.
+
         Keyword arguments:
         dataset      -- Name of dataset to look up
         block        -- Name of block to look up
@@ -151,6 +292,12 @@ class PhEDExAPI:
         values = { 'dataset' : dataset, 'block' : block, 'file' : file_name,
                    'level' : level, 'create_since' : create_since }
 
+        cache = (format == "json") and (not file_name)
+        if cache:
+            check, data = self.cache.get('data', values, instance)
+            if not check:
+                return 0, data
+
         data_url = urllib.basejoin(self.PHEDEX_BASE, "%s/%s/data" % (format, instance))
         check, response = self.phedexCall(data_url, values)
         if check:
@@ -167,11 +314,81 @@ class PhEDExAPI:
             if not data:
                 self.logger.error(name, "No json data available")
                 return 1, "Error"
+            if cache and data.get('phedex', {}).get('dbs'):
+                self.cache.put('data', values, data, instance)
         else:
             data = response.read()
         return 0, data
 
 
+    ############################################################################
+    #                                                                          #
+    #                             D A T A   M A N Y                            #
+    #                                                                          #
+    ############################################################################
+
+    def dataMany(self, key='dataset', values=[], threads=0, **kwargs):
+        """
+        _dataMany_
+
+        Concurrent PhEDEx data calls, one for each value in values
+
+        Keyword arguments:
+        key     -- Argument to vary, dataset/block/file_name
+        values  -- Values of key to look up
+        threads -- Maximum number of concurrent calls
+        kwargs  -- Other data arguments, same for all calls
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        return self.callMany(self.data, key, values, threads, **kwargs)
+
+
+    ############################################################################
+    #                                                                          #
+    #                            D A T A   B A T C H                           #
+    #                                                                          #
+    ############################################################################
+
+    def dataBatch(self, key='dataset', values=[], threads=0, **kwargs):
+        """
+        _dataBatch_
+
+        PhEDEx data calls with many names per call, see callBatch
+
+        A file or block response contains its dataset with only that block,
+        and for a file only that file.
+
+        Keyword arguments:
+        key     -- Argument to vary, dataset/block/file_name
+        values  -- Values of key to look up
+        threads -- Maximum number of concurrent calls
+        kwargs  -- Other data arguments, same for all calls
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        def split(data, names):
+            found = dict()
+            for dbs in data.get('phedex').get('dbs') or []:
+                for dataset in dbs.get('dataset') or []:
+                    if key == 'dataset':
+                        matches = [(dataset.get('name'), dataset)]
+                    else:
+                        matches = []
+                        for block in dataset.get('block') or []:
+                            if key == 'block':
+                                matches.append((block.get('name'), dict(dataset, block=[block])))
+                                continue
+                            for lfn_file in block.get('file') or []:
+                                matches.append((lfn_file.get('lfn'), dict(dataset, block=[dict(block, file=[lfn_file])])))
+                    for match, match_dataset in matches:
+                        found.setdefault(match, []).append(dict(dbs, dataset=[match_dataset]))
+            return dict((name, {'phedex' : {'dbs' : found.get(name, [])}}) for name in names)
+        return self.callBatch(self.data, key, values, split, threads, **kwargs)
+
+
     ############################################################################
     #                                                                          #
     #                                 P A R S E                                #
@@ -240,9 +457,9 @@ class PhEDExAPI:
             return 1, "Error"
         xml = '<data version="2">'
         xml = '%s<%s name="https://cmsweb.cern.ch/dbs/%s/global/DBSReader">' % (xml, 'dbs', instance)
+        responses = self.dataMany(key='dataset', values=datasets, level='file', instance=instance)
         for dataset in datasets:
-            check = 1
-            check, response = self.data(dataset=dataset, level='file', instance=instance)
+            check, response = responses[dataset]
             if check:
                 return 1, "Error"
             data = response.get('phedex').get('dbs')
@@ -458,6 +675,11 @@ class PhEDExAPI:
                    'custodial' : custodial, 'group' : group,
                    'show_dataset' : show_dataset }
 
+        if format == "json":
+            check, data = self.cache.get('blockreplicas', values, instance)
+            if not check:
+                return 0, data
+
         data_url = urllib.basejoin(self.PHEDEX_BASE, "%s/%s/blockreplicas" % (format, instance))
         check, response = self.phedexCall(data_url, values)
         if check:
@@ -467,11 +689,116 @@ class PhEDExAPI:
             data = json.load(response)
             if not data:
                 return 1, "No json data available"
+            self.cache.put('blockreplicas', values, data, instance)
         else:
             data = response
         return 0, data
 
 
+    ############################################################################
+    #                                                                          #
+    #                 B L O C K   R E P L I C A S   S T R E A M                #
+    #                                                                          #
+    ############################################################################
+
+    def blockReplicasStream(self, fields=None, block="", dataset="", node="",
+                            se="", update_since="", create_since="",
+                            complete="", dist_complete="", subscribed="",
+                            custodial="", group="", instance="prod"):
+        """
+        _blockReplicasStream_
+
+        PhEDEx blockReplicas call decoded one block at a time
+
+        Blocks are decoded while the response is still arriving and only the
+        requested fields are kept, memory use doesn't depend on the size of
+        the response. Responses are not cached.
+
+        The generator raises ValueError if the response is malformed and
+        socket.error or httplib.HTTPException if the connection fails, the
+        caller have to handle these.
+
+        Keyword arguments:
+        fields -- Fields to keep in each block, see DynDTAJSONStream.project
+        Other arguments are the same as for blockReplicas
+
+        Return values:
+        check  -- 0 if all went well, 1 if error occured
+        blocks -- Generator of blocks or error message
+        """
+        values = { 'block' : block, 'dataset' : dataset, 'node' : node,
+                   'se' : se, 'update_since' : update_since,
+                   'create_since' : create_since, 'complete' : complete,
+                   'dist_complete' : dist_complete, 'subscribed' : subscribed,
+                   'custodial' : custodial, 'group' : group }
+
+        data_url = urllib.basejoin(self.PHEDEX_BASE, "json/%s/blockreplicas" % (instance,))
+        check, response = self.phedexCall(data_url, values, stream=True)
+        if check:
+            # An error occurred
+            return 1, response
+        return 0, iterJSONArray(response, 'block', fields)
+
+
+    ############################################################################
+    #                                                                          #
+    #                   B L O C K   R E P L I C A S   M A N Y                  #
+    #                                                                          #
+    ############################################################################
+
+    def blockReplicasMany(self, key='dataset', values=[], threads=0, **kwargs):
+        """
+        _blockReplicasMany_
+
+        Concurrent PhEDEx blockReplicas calls, one for each value in values
+
+        Keyword arguments:
+        key     -- Argument to vary, ex dataset/node/block
+        values  -- Values of key to look up
+        threads -- Maximum number of concurrent calls
+        kwargs  -- Other blockReplicas arguments, same for all calls
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        return self.callMany(self.blockReplicas, key, values, threads, **kwargs)
+
+
+    ############################################################################
+    #                                                                          #
+    #                  B L O C K   R E P L I C A S   B A T C H                 #
+    #                                                                          #
+    ############################################################################
+
+    def blockReplicasBatch(self, key='dataset', values=[], threads=0, **kwargs):
+        """
+        _blockReplicasBatch_
+
+        PhEDEx blockReplicas calls with many names per call, see callBatch
+
+        Keyword arguments:
+        key     -- Argument to vary, dataset/block
+        values  -- Values of key to look up
+        threads -- Maximum number of concurrent calls
+        kwargs  -- Other blockReplicas arguments, same for all calls
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        def split(data, names):
+            found = dict()
+            for block in data.get('phedex').get('block') or []:
+                match = block.get('name')
+                if key == 'dataset':
+                    match = match.split('#')[0]
+                found.setdefault(match, []).append(block)
+            return dict((name, {'phedex' : {'block' : found.get(name, [])}}) for name in names)
+        if kwargs.get('show_dataset') == 'y':
+            self.logger.error("blockReplicasBatch", "show_dataset is not supported, ignored")
+            kwargs.pop('show_dataset')
+        return self.callBatch(self.blockReplicas, key, values, split, threads, **kwargs)
+
+
     ############################################################################
     #                                                                          #
     #                           D E L E T I O N S                              #
@@ -509,6 +836,11 @@ class PhEDExAPI:
                    'request_since' : request_since, 'complete' : complete,
                    'complete_since' : complete_since }
 
+        if format == "json":
+            check, data = self.cache.get('deletions', values, instance)
+            if not check:
+                return 0, data
+
         data_url = urllib.basejoin(self.PHEDEX_BASE, "%s/%s/deletions" % (format, instance))
         check, response = self.phedexCall(data_url, values)
         if check:
@@ -518,10 +850,44 @@ class PhEDExAPI:
             data = json.load(response)
             if not data:
                 return 1, "No json data available"
+            self.cache.put('deletions', values, data, instance)
         else:
             data = response
         return 0, data
 
+
+    ############################################################################
+    #                                                                          #
+    #                       D E L E T I O N S   B A T C H                      #
+    #                                                                          #
+    ############################################################################
+
+    def deletionsBatch(self, key='dataset', values=[], threads=0, **kwargs):
+        """
+        _deletionsBatch_
+
+        PhEDEx deletions calls with many names per call, see callBatch
+
+        Keyword arguments:
+        key     -- Argument to vary, dataset/block
+        values  -- Values of key to look up
+        threads -- Maximum number of concurrent calls
+        kwargs  -- Other deletions arguments, same for all calls
+
+        Return values:
+        results -- Dictionary value -> (check, data)
+        """
+        def split(data, names):
+            found = dict()
+            for dataset in data.get('phedex').get('dataset') or []:
+                if key == 'dataset':
+                    found.setdefault(dataset.get('name'), []).append(dataset)
+                    continue
+                for block in dataset.get('block') or []:
+                    found.setdefault(block.get('name'), []).append(dict(dataset, block=[block]))
+            return dict((name, {'phedex' : {'dataset' : found.get(name, [])}}) for name in names)
+        return self.callBatch(self.deletions, key, values, split, threads, **kwargs)
+
     ############################################################################
     #                                                                          #
     #                      D E L E T E   R E Q U E S T S                       #
@@ -601,6 +967,11 @@ class PhEDExAPI:
                    'create_since' : create_since, 'limit' : limit,
                    'approval' : approval, 'requested_by' : requested_by }
 
+        if format == "json":
+            check, data = self.cache.get('transferRequests', values, instance)
+            if not check:
+                return 0, data
+
         data_url = urllib.basejoin(self.PHEDEX_BASE, "%s/%s/transferRequests" % (format, instance))
         check, response = self.phedexCall(data_url, values)
         if check:
@@ -610,6 +981,7 @@ class PhEDExAPI:
             data = json.load(response)
             if not data:
                 return 1, "No json data available"
+            self.cache.put('transferRequests', values, data, instance)
         else:
             data = response
         return 0, data
@@ -634,6 +1006,11 @@ class PhEDExAPI:
                    'decide_since' : decide_since, 'decide_until' : decide_until, 'dataset' : dataset,
                    'block' : block, 'decided_by' : decided_by}
 
+        if format == "json":
+            check, data = self.cache.get('requestList', values, instance)
+            if not check:
+                return 0, data
+
         request_url = urllib.basejoin(self.PHEDEX_BASE, "%s/%s/requestList" % (format, instance))
         check, response = self.phedexCall(request_url, values)
         if check:
@@ -645,45 +1022,11 @@ class PhEDExAPI:
             data = json.load(response)
             if not data:
                 return 1, "No json data available"
+            self.cache.put('requestList', values, data, instance)
         else:
             data = response
         return 0, data
 
-################################################################################
-#                                                                              #
-#                H T T P S   G R I D   A U T H   H A N D L E R                 #
-#                                                                              #
-################################################################################
-class HTTPSGridAuthHandler(urllib2.HTTPSHandler):
-    """
-    _HTTPSGridAuthHandler_
-
-    Get  proxy to acces PhEDEx API
-
-    Needed for subscribe and delete calls
-
-    Class variables:
-    key  -- User key to CERN with access to PhEDEx
-    cert -- User certificate connected to key
-    """
-    def __init__(self):
-        urllib2.HTTPSHandler.__init__(self)
-        self.key = self.getProxy()
-        self.cert = self.key
-
-    def https_open(self, req):
-        return self.do_open(self.getConnection, req)
-
-    def getProxy(self):
-        proxy = os.environ.get("X509_USER_PROXY")
-        if not proxy:
-            proxy = "/tmp/x509up_u%d" % (os.geteuid(),)
-        return proxy
-
-    def getConnection(self, host, timeout=300):
-        return httplib.HTTPSConnection(host, key_file=self.key, cert_file=self.cert)
-
-
 ################################################################################
 #                                                                              #
 #                                  M A I N                                     #
@@ -20,13 +20,17 @@ import urllib2
 import httplib
 import time
 import datetime
+import socket
+import urlparse
+import cookielib
 try:
     import json
 except ImportError:
     import simplejson as json
-from subprocess import call, Popen, PIPE
+from subprocess import call
 
-from DynDTALogger import DynDTALogger
+from DynDTALogger         import DynDTALogger
+from DynDTAConnectionPool import DynDTAConnectionPool
 
 
 ################################################################################
@@ -47,6 +51,8 @@ class PopDBAPI():
     CERT        -- Path to .pem file
     KEY         -- Path to .key file
     COOKIE      -- Path to sso cookie file
+    cookies     -- In memory SSO cookie jar, loaded from COOKIE
+    pool        -- Keep-alive connections to the Popularity DB
     """
     # Useful variables
     # POP_DB_BASE = "https://cms-popularity.cern.ch/popdb/popularity/"
@@ -65,6 +71,10 @@ class PopDBAPI():
         self.CERT        = "/home/bockelman/barrefors/certs/myCert.pem"
         self.KEY         = "/home/bockelman/barrefors/certs/myCert.key"
         self.COOKIE      = "/home/bockelman/barrefors/certs/ssocookie.txt"
+        # Same as curl -k, server certificate is not verified
+        self.pool        = DynDTAConnectionPool(verify=False)
+        self.cookies     = cookielib.CookieJar()
+        self.loadSSOCookie()
 
 
     ############################################################################
@@ -80,6 +90,49 @@ class PopDBAPI():
         Renew the SSO Cookie used for accessing popularity db
         """
         call(["cern-get-sso-cookie", "--cert", self.CERT, "--key", self.KEY, "-u", self.POP_DB_BASE, "-o", self.COOKIE])
+        self.loadSSOCookie()
+
+
+    ############################################################################
+    #                                                                          #
+    #                       L O A D   S S O   C O O K I E                      #
+    #                                                                          #
+    ############################################################################
+
+    def loadSSOCookie(self):
+        """
+        _loadSSOCookie_
+
+        Load the SSO cookie file into the in memory cookie jar
+
+        The file is in Netscape format, cern-get-sso-cookie writes HttpOnly
+        cookies with a #HttpOnly_ prefix which cookielib would skip as comments.
+        """
+        name = "loadSSOCookie"
+        self.cookies.clear()
+        try:
+            cookie_fd = open(self.COOKIE)
+        except IOError, e:
+            self.logger.error(name, "Couldn't read cookie file. Reason: %s" % (e,))
+            return 1
+        for line in cookie_fd:
+            line = line.strip()
+            if line.startswith("#HttpOnly_"):
+                line = line[len("#HttpOnly_"):]
+            if (not line) or line.startswith("#"):
+                continue
+            try:
+                domain, domain_specified, path, secure, expires, key, value = line.split("\t")
+            except ValueError:
+                continue
+            cookie = cookielib.Cookie(0, key, value, None, False, domain,
+                                      domain_specified == "TRUE",
+                                      domain.startswith("."), path, True,
+                                      secure == "TRUE", int(expires or 0) or None,
+                                      False, None, None, {})
+            self.cookies.set_cookie(cookie)
+        cookie_fd.close()
+        return 0
 
 
     ############################################################################
@@ -92,18 +145,39 @@ class PopDBAPI():
         """
         _PopDBCall_
 
-        cURL PopDB API call.
+        PopDB API call.
+
+        Redirects are followed and cookies set by the server are kept in the
+        in memory cookie jar.
+
+        Return values:
+        check    -- 0 if all went well, 1 if error occured
+        response -- File like body of the response, read it to the end to
+                    give the connection back to the pool
         """
         name = "PopDBAPICall"
-        data = urllib.urlencode(values)
-        request = urllib2.Request(url, data)
-        full_url = request.get_full_url() + request.get_data()
-        p1 = Popen(["curl", "-k", "-s", "-L", "--cookie", self.COOKIE, "--cookie-jar", self.COOKIE, full_url], stdout=PIPE)
-        try:
-            response = p1.communicate()[0]
-        except ValueError:
-            return 1, "Error"
-        return 0, response
+        full_url = url + urllib.urlencode(values)
+        for i in range(10):
+            request = urllib2.Request(full_url)
+            self.cookies.add_cookie_header(request)
+            headers = dict(request.header_items())
+            try:
+                response, body = self.pool.request('GET', full_url, headers=headers, stream=True)
+            except (httplib.HTTPException, socket.error), e:
+                self.logger.error(name, "URL: %s : %s" % (full_url, str(e)))
+                return 1, "Error"
+            self.cookies.extract_cookies(PopDBResponseInfo(response), request)
+            if response.status in (301, 302, 303, 307):
+                body.read()
+                full_url = urlparse.urljoin(full_url, response.getheader('location'))
+                continue
+            if response.status != 200:
+                body.read()
+                self.logger.error(name, "URL: %s : HTTP status %d" % (full_url, response.status))
+                return 1, "Error"
+            return 0, body
+        self.logger.error(name, "URL: %s : Too many redirects" % (full_url,))
+        return 1, "Error"
 
 
     ############################################################################
@@ -137,11 +211,35 @@ class PopDBAPI():
         if check:
             self.logger.error(name, "getDSStatInTimeWindow call failed.")
             return 1, "Error"
-        json_data = json.loads(response)
+        try:
+            json_data = json.load(response)
+        except ValueError, e:
+            self.logger.error(name, "Couldn't decode response : %s" % (str(e),))
+            return 1, "Error"
         data = json_data.get('DATA')
         return 0, data
 
 
+################################################################################
+#                                                                              #
+#                  P O P   D B   R E S P O N S E   I N F O                     #
+#                                                                              #
+################################################################################
+
+class PopDBResponseInfo:
+    """
+    _PopDBResponseInfo_
+
+    Give cookielib access to the headers of a httplib response, cookielib
+    expects urllib2 style responses.
+    """
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+
 ################################################################################
 #                                                                              #
 #                                  M A I N                                     #
@@ -0,0 +1,59 @@
+"""
+_test_DynDTAJSONStream_
+
+Tests of the streaming JSON array decoder
+"""
+
+import testenv
+
+import json
+import unittest
+
+from cStringIO import StringIO
+
+from DynDTAJSONStream import iterJSONArray
+
+
+class IterJSONArrayTest(unittest.TestCase):
+    """
+    _IterJSONArrayTest_
+
+    The decoded elements don't depend on where the chunks are split
+    """
+    def decode(self, document, key, fields=None):
+        results = []
+        for chunk_size in range(1, len(document) + 2):
+            results.append(list(iterJSONArray(StringIO(document), key, fields, chunk_size)))
+        return results
+
+    def test_split_numbers(self):
+        elements = [1, 2.5, -30, 4e3, 12345, 0.125]
+        document = json.dumps({'phedex' : {'values' : elements}})
+        for result in self.decode(document, 'values'):
+            self.assertEqual(result, elements)
+
+    def test_split_literals(self):
+        elements = [True, None, False, 'abc', None]
+        document = json.dumps({'values' : elements})
+        for result in self.decode(document, 'values'):
+            self.assertEqual(result, elements)
+
+    def test_projected_blocks(self):
+        blocks = [{'name' : '/A/B/AOD#%d' % (i,), 'bytes' : 1000*i, 'files' : i} for i in range(5)]
+        document = json.dumps({'phedex' : {'request_timestamp' : 1.5, 'block' : blocks}})
+        expected = [{'name' : block['name'], 'bytes' : block['bytes']} for block in blocks]
+        for result in self.decode(document, 'block', {'name' : None, 'bytes' : None}):
+            self.assertEqual(result, expected)
+
+    def test_empty_array(self):
+        for result in self.decode('{"block" : [ ]}', 'block'):
+            self.assertEqual(result, [])
+
+    def test_truncated(self):
+        for chunk_size in (1, 4, 1024):
+            self.assertRaises(ValueError, list, iterJSONArray(StringIO('{"values" : [1, 2.'), 'values', chunk_size=chunk_size))
+            self.assertRaises(ValueError, list, iterJSONArray(StringIO('{"other" : [1]}'), 'values', chunk_size=chunk_size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+_test_DynDTAListener_
+
+Tests of the directory lookups of the listener
+"""
+
+import testenv
+
+import time
+import json
+import unittest
+import multiprocessing
+
+from cStringIO import StringIO
+
+import DynDTAListener
+from DynDTADatabase import DynDTADatabase
+from DynDTALRUCache import DynDTALRUCache
+
+
+class NegativeLookupTest(unittest.TestCase):
+    """
+    _NegativeLookupTest_
+
+    A file PhEDEx doesn't know is not looked up again until its negative entry
+    expires, then PhEDEx is asked again and not answered from any cache.
+    """
+    LFN = '/store/group/phys/Run2016/f.root'
+
+    def setUp(self):
+        self.listener = DynDTAListener.DynDTAListener()
+        self.listener.unresolved_ttl = 1
+        self.calls = []
+        self.known = False
+        self.listener.phedex.phedexCall = self.phedexCall
+        self.database = DynDTADatabase(db_file='negative_%f.db' % (time.time(),))
+        self.cache = DynDTALRUCache()
+
+    def phedexCall(self, url, values, stream=False):
+        self.calls.append(values['file'])
+        dbs = []
+        if self.known:
+            dbs = [{'name' : 'dbs', 'dataset' : [{'name' : '/A/B/AOD', 'block' : [
+                      {'name' : '/A/B/AOD#1', 'file' : [{'lfn' : lfn} for lfn in values['file']]}]}]}]
+        return 0, StringIO(json.dumps({'phedex' : {'dbs' : dbs}}))
+
+    def handle(self):
+        self.listener.dataHandler({'file_lfn' : self.LFN}, self.database, self.cache)
+        self.database.flush()
+
+    def test_retry_after_ttl(self):
+        self.handle()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.database.lookup(self.listener.directory(self.LFN))[1], '')
+        # Registered in PhEDEx, but the negative entry is still valid
+        self.known = True
+        self.handle()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.database.accessCounts(), {})
+        time.sleep(1.5)
+        self.handle()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.database.accessCounts(), {'/A/B/AOD' : 1})
+
+    def test_file_lookups_not_cached(self):
+        # Responses of a batch with some files found are not reused either
+        self.known = True
+        directory = self.listener.directory(self.LFN)
+        self.listener.resolve([(directory, self.LFN)])
+        self.listener.resolve([(directory, self.LFN)])
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failed_ttl_from_database(self):
+        # Negative entry stored by another worker after PhEDEx failed
+        directory = self.listener.directory(self.LFN)
+        self.database.insertDirectory(directory, '', hours=self.listener.failed_ttl/3600.0)
+        self.database.flush()
+        self.handle()
+        self.assertEqual(len(self.calls), 0)
+        ttl = self.cache.entries[directory][1] - time.time()
+        self.assertTrue(ttl <= self.listener.failed_ttl)
+
+
+class PrefetchTest(unittest.TestCase):
+    """
+    _PrefetchTest_
+
+    Datasets resolved by several workers are fetched once by the shared
+    prefetch process and their directories end up in the database.
+    """
+    def setUp(self):
+        self.calls = multiprocessing.Value('i', 0)
+        DynDTAListener.listener.phedex.phedexCall = self.phedexCall
+        # Only the prefetch process may keep PhEDEx from being called again
+        DynDTAListener.listener.phedex.cache.max_bytes = 0
+
+    def phedexCall(self, url, values, stream=False):
+        with self.calls.get_lock():
+            self.calls.value += 1
+        files = [{'lfn' : '/store/data/Run2016/A/AOD/B-v1/%03d/0/f.root' % (i,)} for i in range(2)]
+        dbs = [{'name' : 'dbs', 'dataset' : [{'name' : values['dataset'], 'block' : [{'name' : '#1', 'file' : files}]}]}]
+        return 0, StringIO(json.dumps({'phedex' : {'dbs' : dbs}}))
+
+    def test_fetched_once(self):
+        requests = multiprocessing.Queue()
+        prefetcher = DynDTAListener.startPrefetcher(requests)
+        try:
+            # Two workers resolve the same dataset
+            for i in range(2):
+                worker = DynDTAListener.DynDTAListener()
+                worker.startPrefetch(requests)
+                worker.prefetch('/A/Run2016-B-v1/AOD')
+                worker.prefetch('/A/Run2016-B-v1/AOD')
+            database = DynDTADatabase()
+            for i in range(50):
+                check, dataset, ttl = database.lookup('/store/data/Run2016/A/AOD/B-v1/001')
+                if not check:
+                    break
+                time.sleep(0.1)
+            time.sleep(0.5)
+        finally:
+            prefetcher.terminate()
+        self.assertEqual(dataset, '/A/Run2016-B-v1/AOD')
+        self.assertEqual(database.lookup('/store/data/Run2016/A/AOD/B-v1/000')[1], '/A/Run2016-B-v1/AOD')
+        self.assertEqual(self.calls.value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
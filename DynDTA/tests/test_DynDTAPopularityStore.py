@@ -0,0 +1,106 @@
+"""
+_test_DynDTAPopularityStore_
+
+Tests of the local store of daily Popularity DB statistics
+"""
+
+import testenv
+
+import time
+import datetime
+import unittest
+
+from DynDTAPopularityStore import DynDTAPopularityStore
+
+
+class FakePopDBAPI:
+    """
+    _FakePopDBAPI_
+
+    Serve daily statistics from a dictionary day -> list of datasets and
+    record the days requested
+    """
+    def __init__(self, days):
+        self.days = days
+        self.calls = []
+        self.fail = set()
+
+    def getDSStatInTimeWindow(self, tstart='', tstop='', sitename='summary'):
+        self.calls.append(tstart)
+        if tstart in self.fail:
+            return 1, "Error"
+        return 0, self.days.get(tstart, [])
+
+
+class PopularityStoreTest(unittest.TestCase):
+    """
+    _PopularityStoreTest_
+
+    Days are downloaded once they are settled and windows are summed from the
+    stored days
+    """
+    def setUp(self):
+        self.today = datetime.date.today()
+        self.day = lambda n: self.today - datetime.timedelta(days=n)
+        stat = lambda dataset, n_acc, n_users, cpu: {'COLLNAME' : dataset, 'NACC' : n_acc,
+                                                     'NUSERS' : n_users, 'TOTCPU' : cpu}
+        self.pop_db_api = FakePopDBAPI({
+            self.day(10) : [stat('/A/B/AOD', 100, 2, 1.5), stat('/C/D/AOD', 10, 1, 0.5)],
+            self.day(9)  : [stat('/A/B/AOD', 50, 1, 1.0)],
+            self.day(8)  : [stat('/C/D/AOD', 200, 3, 4.0), stat('/E/F/AOD', 1, 1, None)],
+            self.day(0)  : [stat('/A/B/AOD', 7, 1, 0.25)]})
+        self.store = DynDTAPopularityStore(self.pop_db_api, db_path=testenv.TMP_PATH,
+                                           db_file='popularity_%f.db' % (time.time(),))
+
+    def test_stat_in_time_window(self):
+        check, data = self.store.statInTimeWindow(self.day(10), self.day(8))
+        self.assertEqual(check, 0)
+        self.assertEqual(data, [{'COLLNAME' : '/C/D/AOD', 'NACC' : 210, 'NUSERS' : 4, 'TOTCPU' : 4.5},
+                                {'COLLNAME' : '/A/B/AOD', 'NACC' : 150, 'NUSERS' : 3, 'TOTCPU' : 2.5},
+                                {'COLLNAME' : '/E/F/AOD', 'NACC' : 1, 'NUSERS' : 1, 'TOTCPU' : 0.0}])
+        self.assertEqual(self.pop_db_api.calls, [self.day(10), self.day(9), self.day(8)])
+
+    def test_series(self):
+        check, datasets, matrices = self.store.series(self.day(9), self.day(8))
+        self.assertEqual(sorted(datasets), ['/A/B/AOD', '/C/D/AOD', '/E/F/AOD'])
+        n_acc = dict(zip(datasets, matrices['NACC'].tolist()))
+        self.assertEqual(n_acc, {'/A/B/AOD' : [50, 0], '/C/D/AOD' : [0, 200], '/E/F/AOD' : [0, 1]})
+        check, datasets, matrices = self.store.series(self.day(3), self.day(2))
+        self.assertEqual(datasets, [])
+        self.assertEqual(matrices['NACC'].shape, (0, 2))
+
+    def test_settled_days_not_downloaded_again(self):
+        self.store.statInTimeWindow(self.day(10), self.day(0))
+        self.assertEqual(len(self.pop_db_api.calls), 11)
+        # Only days which haven't settled are downloaded again, once refresh has passed
+        self.store.statInTimeWindow(self.day(10), self.day(0))
+        self.assertEqual(len(self.pop_db_api.calls), 11)
+        self.store.refresh = 0
+        self.store.statInTimeWindow(self.day(10), self.day(0))
+        self.assertEqual(self.pop_db_api.calls[11:], [self.day(1), self.day(0)])
+
+    def test_failed_day_retried(self):
+        self.pop_db_api.fail.add(self.day(9))
+        check, data = self.store.statInTimeWindow(self.day(10), self.day(9))
+        self.assertEqual(check, 1)
+        self.assertEqual(data[0]['NACC'], 100)
+        self.pop_db_api.fail = set()
+        check, data = self.store.statInTimeWindow(self.day(10), self.day(9))
+        self.assertEqual(check, 0)
+        self.assertEqual(data[0]['NACC'], 150)
+        self.assertEqual(self.pop_db_api.calls, [self.day(10), self.day(9), self.day(9)])
+
+    def test_future_days_skipped(self):
+        self.store.statInTimeWindow(self.day(0), self.today + datetime.timedelta(days=2))
+        self.assertEqual(self.pop_db_api.calls, [self.day(0)])
+
+    def test_weighted_popularity(self):
+        check, popularity = self.store.weightedPopularity(self.day(8), days=3, half_life=1.0)
+        self.assertEqual(check, 0)
+        self.assertAlmostEqual(popularity['/A/B/AOD'], 100*0.25 + 50*0.5)
+        self.assertAlmostEqual(popularity['/C/D/AOD'], 10*0.25 + 200)
+        self.assertAlmostEqual(popularity['/E/F/AOD'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
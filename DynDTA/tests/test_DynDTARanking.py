@@ -0,0 +1,106 @@
+"""
+_test_DynDTARanking_
+
+Tests of the vectorized ranking against the original per dataset ranking
+"""
+
+import testenv
+
+import math
+import random
+import unittest
+
+from DynDTARanking import DynDTARanking
+
+
+def baselineRanking(candidates, accesses, n_replicas, size_TB):
+    """
+    _baselineRanking_
+
+    Ranking loop of DynDTA.run before the vectorized ranking, datasets ranked
+    below 200 are dropped
+    """
+    datasets = dict()
+    for dataset, access in candidates.iteritems():
+        n_access_t = access
+        try:
+            n_access_2t = accesses[dataset]
+        except KeyError:
+            n_access_2t = n_access_t
+        rank = (math.log10(n_access_t)*max(2*n_access_t
+                - n_access_2t, 1))/(size_TB[dataset]*(n_replicas[dataset]**2))
+        datasets[dataset] = rank
+    sorted_ranking = sorted(datasets.iteritems(), key=lambda item: item[1])
+    for rank in sorted_ranking:
+        if rank[1] < 200:
+            del datasets[rank[0]]
+    return datasets
+
+
+class RankingTest(unittest.TestCase):
+    """
+    _RankingTest_
+
+    The popularity formula keeps the same datasets with the same ranks as the
+    original implementation
+    """
+    def setUp(self):
+        self.ranking = DynDTARanking()
+
+    def rank(self, candidates, accesses, n_replicas, size_TB):
+        names = candidates.keys()
+        return self.ranking.rank(names,
+                                 [candidates[dataset] for dataset in names],
+                                 [accesses.get(dataset, candidates[dataset]) for dataset in names],
+                                 [n_replicas[dataset] for dataset in names],
+                                 [size_TB[dataset] for dataset in names])
+
+    def test_matches_baseline(self):
+        generator = random.Random(1)
+        for run in range(20):
+            candidates = dict()
+            accesses = dict()
+            n_replicas = dict()
+            size_TB = dict()
+            for i in range(200):
+                dataset = '/A%d/B/AOD' % (i,)
+                candidates[dataset] = generator.randint(1, 100000)
+                if generator.random() < 0.8:
+                    accesses[dataset] = candidates[dataset] + generator.randint(0, 200000)
+                n_replicas[dataset] = generator.randint(1, 10)
+                size_TB[dataset] = generator.uniform(0.01, 20)
+            expected = baselineRanking(candidates, accesses, n_replicas, size_TB)
+            ranking = self.rank(candidates, accesses, n_replicas, size_TB)
+            self.assertTrue(expected)
+            self.assertEqual(set(dataset for dataset, rank in ranking), set(expected))
+            for dataset, rank in ranking:
+                self.assertAlmostEqual(rank, expected[dataset], delta=1e-9*expected[dataset])
+            ranks = [rank for dataset, rank in ranking]
+            self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_threshold_boundary(self):
+        # log10(1000)*1000/(15*1) = 200 exactly, kept by both implementations
+        candidates = {'/A/B/AOD' : 1000, '/C/D/AOD' : 1000}
+        accesses = {'/A/B/AOD' : 1000, '/C/D/AOD' : 1001}
+        n_replicas = {'/A/B/AOD' : 1, '/C/D/AOD' : 1}
+        size_TB = {'/A/B/AOD' : 15, '/C/D/AOD' : 15}
+        expected = baselineRanking(candidates, accesses, n_replicas, size_TB)
+        ranking = self.rank(candidates, accesses, n_replicas, size_TB)
+        self.assertEqual(set(expected), set(['/A/B/AOD']))
+        self.assertEqual([dataset for dataset, rank in ranking], ['/A/B/AOD'])
+
+    def test_uncomputable_ranks(self):
+        # Zero accesses or size would raise in the original loop
+        ranking = self.ranking.rank(['/A/B/AOD', '/C/D/AOD', '/E/F/AOD'],
+                                    [0, 100000, 100000], [0, 100000, 100000],
+                                    [1, 1, 1], [1, 0, 1])
+        self.assertEqual([dataset for dataset, rank in ranking], ['/E/F/AOD'])
+        self.assertEqual(DynDTARanking(threshold=0).rank(['/A/B/AOD'], [0], [0], [1], [1]),
+                         [('/A/B/AOD', 0.0)])
+
+    def test_empty(self):
+        self.assertEqual(self.ranking.rank([], [], [], [], []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+_testenv_
+
+Common set up for the DynDTA unit tests.
+
+Puts the DynDTA modules on the path, silences the logger and makes classes
+which create files under /home/bockelman by default create them in a
+temporary directory instead. Import before any DynDTA module.
+
+Run the tests from the DynDTA directory with
+python -m unittest discover -s tests
+"""
+
+import sys
+import os
+import atexit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DynDTALogger
+
+
+class NullLogger:
+    """
+    _NullLogger_
+
+    Drop all log and error messages
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def log(self, name, msg):
+        pass
+
+    def error(self, name, msg):
+        pass
+
+
+DynDTALogger.DynDTALogger = NullLogger
+
+TMP_PATH = tempfile.mkdtemp(prefix='dyndta-test-') + '/'
+atexit.register(shutil.rmtree, TMP_PATH, True)
+
+
+def tmpDefaults(cls):
+    """
+    _tmpDefaults_
+
+    Make db_path of cls default to the temporary directory
+    """
+    function = cls.__init__.im_func
+    defaults = list(function.func_defaults)
+    defaults[0] = TMP_PATH
+    function.func_defaults = tuple(defaults)
+
+
+import DynDTACache
+import DynDTADatabase
+
+tmpDefaults(DynDTACache.DynDTACache)
+tmpDefaults(DynDTADatabase.DynDTADatabase)